@@ -0,0 +1,423 @@
+'''
+This module provides a reproducible benchmark suite for the repoAnalysis module.
+It consists of two parts:
+- A generator that builds synthetic Java repositories of configurable size (commits, files, file length, branchiness, and mix of Java constructs) with `git fast-import`
+- Harnesses that measure commits/sec and blobs/sec of `calculateMetrics`, `calculateDeltaMetrics`, each metric function of a suite, and `runFullAnalysis` end to end at several pool sizes
+Additionally, `checkApproaches` checks on a generated repository that the incremental approach c gives the same results as approach a, and the hunk engine the same deltas as the blob engine
+Results are saved as json files, which can be compared across versions with `compareResults`. Run `python benchmark.py --help` for the command line
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+from IPython.utils import io
+
+import repoLibrarian
+import repoAnalysis
+import metricCache
+import resultSink
+
+# ===== Synthetic repository generator =====
+'''
+Relative frequencies of the Java constructs of generated lines; every construct is counted by at least one metric of the default suite.
+Can be changed per generated repository by passing a dict with other weights to `generateRepo`
+'''
+defaultConstructs = {
+    'statement': 10,
+    'method': 2,
+    'lambda': 2,
+    'lineComment': 2,
+    'blockComment': 1,
+    'string': 2,
+    'reflection': 1,
+    'snake': 2,
+}
+
+def javaLine(construct, rand):
+    '''A random line of Java code of the given construct'''
+    name = rand.choice(['value', 'count', 'result', 'item', 'node', 'buffer'])
+    number = rand.randint(0, 999)
+    if construct == 'method':
+        return rand.choice(['public', 'private', 'protected', 'static']) + ' int ' + name + str(number) + '(int ' + name + ') {'
+    if construct == 'lambda':
+        return rand.choice(['list.forEach(x -> x.update(' + str(number) + '));', 'stream.map(Item::' + name + ').count();'])
+    if construct == 'lineComment':
+        return '// ' + name + ' ' + str(number) + ' has to be checked'
+    if construct == 'blockComment':
+        return '/* ' + name + '\n * is ' + str(number) + '\n */'
+    if construct == 'string':
+        return 'String ' + name + ' = "' + name + ' // ' + str(number) + '";'
+    if construct == 'reflection':
+        return rand.choice(['if (' + name + ' instanceof Node) { }', 'Class<?> type = Node.class.getName();'])
+    if construct == 'snake':
+        return 'int ' + name + '_' + str(number) + ' = MAX_' + name.upper() + ';'
+    return name + ' = ' + name + ' + ' + str(number) + ';'
+
+def javaLines(count, constructs, rand):
+    '''A list of random, indented Java lines'''
+    kinds = list(constructs)
+    weights = [constructs[kind] for kind in kinds]
+    return [rand.choice(['    ', '        ', '\t', '\t\t']) + javaLine(kind, rand) for kind in rand.choices(kinds, weights, k=count)]
+
+def javaFile(name, lines):
+    '''Full source of a Java class with the given body lines'''
+    return 'package bench;\n\nimport java.util.*;\n\n/** Generated class ' + name + ' */\npublic class ' + name + ' {\n' + '\n'.join(lines) + '\n}\n'
+
+def changeLines(lines, fileLength, constructs, rand):
+    '''Randomly replaces, inserts, and deletes a few lines of a file, so that its length stays around the given file length'''
+    lines = list(lines)
+    for _ in range(rand.randint(1, 5)):
+        position = rand.randint(0, len(lines))
+        action = rand.random()
+        if action < 0.4 and position < len(lines):
+            lines[position:position + 1] = javaLines(1, constructs, rand)
+        elif action < 0.7 + 0.3 * (len(lines) < fileLength):
+            lines[position:position] = javaLines(rand.randint(1, 4), constructs, rand)
+        elif lines:
+            del lines[min(position, len(lines) - 1)]
+    return lines
+
+def generateRepo(user, project, commits=200, files=40, fileLength=100, branchiness=0.1, constructs=None, seed=0, maxChanges=3, specialPaths=0, crlf=0, missingNewlines=0):
+    '''
+    Generates a bare Java repository in the repos folder (see repoLibrarian) and registers it in the manifest; an existing repository of that name is replaced.
+    - commits: number of non-merge commits
+    - files: number of Java files the project grows to, it starts with a fifth of them
+    - fileLength: average number of lines per file
+    - branchiness: probability of starting a side branch at a commit, side branches are merged back into main after a few commits
+    - constructs: relative frequencies of Java constructs, see `defaultConstructs`
+    - maxChanges: maximum number of files that are changed per commit
+    - specialPaths: share of new files whose path contains non-ascii letters and spaces, which git quotes in its output
+    - crlf: share of file versions that are written with CRLF line breaks
+    - missingNewlines: share of file versions without line break at the end
+    The same parameters and seed always give the same repository, including commit shas
+    '''
+    rand = random.Random(seed)
+    constructs = constructs or defaultConstructs
+    repoPath = repoLibrarian.pathFor(user, project)
+    if os.path.isdir(repoPath):
+        repoLibrarian.deleteRepo(user, project)
+    os.makedirs(repoPath)
+    subprocess.run(['git', 'init', '--quiet', '--bare', repoPath], check=True)
+    stream = []
+    marks = iter(range(1, sys.maxsize))
+    timestamp = 1577836800
+
+    def blob(content):
+        mark = next(marks)
+        data = content.encode()
+        stream.append(b'blob\nmark :%d\ndata %d\n%s\n' % (mark, len(data), data))
+        return mark
+
+    def commit(branch, parents, changes, message):
+        nonlocal timestamp
+        timestamp += rand.randint(60, 3600)
+        mark = next(marks)
+        blobs = [(path, blob(content)) for path, content in changes.items() if content is not None]
+        lines = [b'commit refs/heads/%s' % branch.encode(), b'mark :%d' % mark,
+            b'committer Bench <bench@example.org> %d +0000' % timestamp, b'data %d' % len(message), message.encode()]
+        lines += [b'from :%d' % parents[0]] if parents else []
+        lines += [b'merge :%d' % parent for parent in parents[1:]]
+        lines += [b'M 100644 :%d %s' % (blobMark, path.encode()) for path, blobMark in blobs]
+        lines += [b'D %s' % path.encode() for path, content in changes.items() if content is None]
+        stream.append(b'\n'.join(lines) + b'\n\n')
+        return mark
+
+    def source(change):
+        '''Content of a file version; line breaks are chosen by the version itself, so that merges write the same content as the side branch'''
+        content = javaFile(*change)
+        if crlf or missingNewlines:
+            style = random.Random(str(seed) + repr(change))
+            if style.random() < crlf:
+                content = content.replace('\n', '\r\n')
+            if style.random() < missingNewlines:
+                content = content.rstrip('\r\n')
+        return content
+
+    def evolve(state, number):
+        '''Changes, adds, or deletes some files of a branch state, returns the changes (None for deleted files)'''
+        changes = {}
+        for _ in range(rand.randint(1, maxChanges)):
+            if len(state) < files and rand.random() < 0.3 or not state:
+                name = 'Class' + str(number) + '_' + str(len(changes))
+                folder = 'src/bench/' if not specialPaths or rand.random() >= specialPaths else 'src/bänch/Größe '
+                changes[folder + name + '.java'] = (name, javaLines(rand.randint(fileLength // 2, fileLength * 3 // 2), constructs, rand))
+            elif rand.random() < 0.03 and len(state) > 1:
+                changes[rand.choice(sorted(state))] = None
+            else:
+                path = rand.choice(sorted(state))
+                (name, lines) = state[path]
+                changes[path] = (name, changeLines(lines, fileLength, constructs, rand))
+        for path, change in changes.items():
+            if change is None:
+                state.pop(path, None)
+            else:
+                state[path] = change
+        return {path: None if change is None else source(change) for path, change in changes.items()}
+
+    main = {}
+    for number in range(max(1, files // 5)):
+        name = 'Class' + str(number)
+        main['src/bench/' + name + '.java'] = (name, javaLines(rand.randint(fileLength // 2, fileLength * 3 // 2), constructs, rand))
+    mainTip = commit('main', [], {path: source(change) for path, change in main.items()}, 'Initial commit')
+    side = None
+    for number in range(1, commits):
+        if side is None and rand.random() < branchiness:
+            side = {'state': dict(main), 'tip': mainTip, 'changed': set(), 'left': rand.randint(2, 6)}
+        if side is not None and rand.random() < 0.5:
+            changes = evolve(side['state'], number)
+            side['changed'] |= set(changes)
+            side['tip'] = commit('side', [side['tip']], changes, 'Side commit ' + str(number))
+            side['left'] -= 1
+            if side['left'] == 0:
+                merged = {path: side['state'].get(path) for path in side['changed']}
+                for path, change in merged.items():
+                    if change is None:
+                        main.pop(path, None)
+                    else:
+                        main[path] = change
+                mainTip = commit('main', [mainTip, side['tip']], {path: None if change is None else source(change) for path, change in merged.items()}, 'Merge side')
+                side = None
+        else:
+            mainTip = commit('main', [mainTip], evolve(main, number), 'Commit ' + str(number))
+    subprocess.run(['git', '--git-dir', repoPath, 'fast-import', '--quiet'], input=b''.join(stream), check=True)
+    subprocess.run(['git', '--git-dir', repoPath, 'symbolic-ref', 'HEAD', 'refs/heads/main'], check=True)
+    repoLibrarian.registerRepo(user, project)
+    return repoPath
+
+
+# ===== Harnesses =====
+def workOf(repoTuple):
+    '''
+    Counts the work of the analysis approaches for a repository:
+    all commits, delta commits (non-merge commits with parent), java blobs of all commit trees (read by approach a), and changed java blobs of delta commits (read by approach b)
+    '''
+    (user, project, repoId) = repoTuple
+    git = repoLibrarian.getRepo(user, project).git
+    shas = git.rev_list('--all').split()
+    treeBlobs = sum(sum(1 for path in git.ls_tree('-r', '--name-only', sha).split('\n') if path.endswith('.java')) for sha in shas)
+    deltaCommits = 0
+    changedBlobs = 0
+    for block in git.log('--all', '--no-merges', '--raw', '--no-abbrev', '--format=//%P').split('//')[1:]:
+        lines = block.split('\n')
+        if not lines[0].strip():
+            continue
+        deltaCommits += 1
+        for line in lines[1:]:
+            if line.startswith(':') and repoAnalysis.unquotePath(line.split('\t')[-1]).endswith('.java'):
+                (oldMode, newMode, oldSha, newSha) = line[1:].split('\t')[0].split()[:4]
+                changedBlobs += (oldSha != metricCache.nullSha) + (newSha != metricCache.nullSha)
+    return {'commits': len(shas), 'deltaCommits': deltaCommits, 'treeBlobs': treeBlobs, 'changedBlobs': changedBlobs}
+
+def rates(name, seconds, commits, blobs, **extra):
+    '''A benchmark result with throughput'''
+    result = {'benchmark': name, 'seconds': seconds, 'commits': commits, 'blobs': blobs,
+        'commitsPerSecond': commits / seconds if seconds else None, 'blobsPerSecond': blobs / seconds if seconds else None}
+    result.update(extra)
+    return result
+
+def benchmarkAbsolute(repoTuple, work, suite=repoAnalysis.metricSuite):
+    '''Measures `calculateMetrics` (approach a) on a repository with empty metric caches'''
+    metricCache.clear()
+    start = time.perf_counter()
+    with io.capture_output():
+        repoAnalysis.calculateMetrics(repoTuple, suite)
+    return rates('calculateMetrics', time.perf_counter() - start, work['commits'], work['treeBlobs'], repo=repoTuple[1])
+
+def benchmarkDelta(repoTuple, work, suite=repoAnalysis.metricSuite):
+    '''Measures `calculateDeltaMetrics` (approach b) on a repository with empty metric caches'''
+    metricCache.clear()
+    start = time.perf_counter()
+    with io.capture_output():
+        repoAnalysis.calculateDeltaMetrics(repoTuple, suite)
+    return rates('calculateDeltaMetrics', time.perf_counter() - start, work['deltaCommits'], work['changedBlobs'], repo=repoTuple[1])
+
+def benchmarkIncremental(repoTuple, work, suite=repoAnalysis.metricSuite):
+    '''Measures `calculateAbsoluteMetrics` (approach c) on a repository with empty metric caches'''
+    metricCache.clear()
+    start = time.perf_counter()
+    with io.capture_output():
+        repoAnalysis.calculateAbsoluteMetrics(repoTuple, suite)
+    return rates('calculateAbsoluteMetrics', time.perf_counter() - start, work['commits'], work['changedBlobs'], repo=repoTuple[1])
+
+def javaBlobsOf(repoTuple):
+    '''Contents of all distinct java blobs in the history of a repository'''
+    (user, project, repoId) = repoTuple
+    repo = repoLibrarian.getRepo(user, project)
+    shas = {line.split()[0] for line in repo.git.rev_list('--all', '--objects').split('\n') if line.endswith('.java')}
+    with repoLibrarian.CatFile(repo) as catFile:
+        return list(catFile.read(sorted(shas)).values())
+
+def benchmarkMetrics(repoTuple, suite=repoAnalysis.metricSuite, repeat=3):
+    '''
+    Measures each metric function of a suite on all distinct java blobs of a repository (best of `repeat` runs),
+    together with the preparation of their inputs (decoding, header, string, and comment removal) and the fused scanner that computes the default suite at once
+    '''
+    blobs = javaBlobsOf(repoTuple)
+    size = sum(map(len, blobs))
+    def best(function):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+    def prepare(data):
+        contentWithHeader = data.decode('CP437')
+        content = repoAnalysis.removeHeader(contentWithHeader)
+        contentWithoutComments = repoAnalysis.commentRegex.sub('/*...*/', repoAnalysis.stringRemoveRegex.sub('"..."', content))
+        return {'content': content, 'contentWithHeader': contentWithHeader, 'contentWithoutComments': contentWithoutComments}
+    inputs = [prepare(data) for data in blobs]
+    results = [rates('prepare', best(lambda: [prepare(data) for data in blobs]), 0, len(blobs), bytes=size, repo=repoTuple[1])]
+    for metricFunction in suite:
+        seconds = best(lambda: [metricFunction(**kwargs) for kwargs in inputs])
+        results.append(rates('metric:'+metricFunction.__name__, seconds, 0, len(blobs), bytes=size, repo=repoTuple[1]))
+    results.append(rates('fusedScanBytes', best(lambda: [repoAnalysis.fusedScanBytes(data) for data in blobs]), 0, len(blobs), bytes=size, repo=repoTuple[1]))
+    return results
+
+def benchmarkFullAnalysis(repos, works, folder, processes=(1, 2, 4)):
+    '''Measures `runFullAnalysis` end to end (writing to an SQLite file in the given folder) for each of the given pool sizes'''
+    results = []
+    commits = sum(work['deltaCommits'] for work in works)
+    blobs = sum(work['changedBlobs'] for work in works)
+    for count in processes:
+        metricCache.clear()
+        database = os.path.join(folder, 'full_'+str(count)+'.db')
+        if os.path.exists(database):
+            os.remove(database)
+        start = time.perf_counter()
+        repoAnalysis.runFullAnalysis(repos, 'benchmark', repoLibrarian.getReposFolder(), logfile=os.path.join(folder, 'log.txt'),
+            target=resultSink.SqlTarget('sqlite:///'+database), processes=count)
+        results.append(rates('runFullAnalysis', time.perf_counter() - start, commits, blobs, processes=count))
+    return results
+
+# ===== Checks =====
+def differences(expected, actual, check):
+    '''Mismatches between two result frames of the same commits as `(check, sha, column)` triples'''
+    expected = expected.set_index('sha').sort_index()
+    actual = actual.set_index('sha').sort_index()
+    if list(expected.index) != list(actual.index):
+        return [(check, sha, 'sha') for sha in set(expected.index) ^ set(actual.index)]
+    differs = lambda a, b: a != b if isinstance(a, str) or a is None else abs(a - b) > 1e-6
+    return [(check, sha, column) for column in expected.columns for sha in expected.index if differs(expected.at[sha, column], actual.at[sha, column])]
+
+def checkApproaches(folder=None, commits=80, files=12, seed=0, suite=repoAnalysis.metricSuite):
+    '''
+    Generates a repository with side branches, special file names, CRLF line breaks, and missing final line breaks (in a temporary folder unless one is given) and checks that
+    - `calculateAbsoluteMetrics` (approach c) gives the same results as `calculateMetrics` (approach a)
+    - the hunk engine gives the same deltas of the line-local metrics of the suite as the blob engine, see `repoAnalysis.deltaMetricsOfRepo`
+    Returns the mismatching `(check, sha, column)` triples, empty if all agree
+    '''
+    folder = folder or tempfile.mkdtemp(prefix='check_')
+    previousFolder = repoLibrarian.getReposFolder()
+    repoLibrarian.setReposFolder(os.path.join(folder, 'repos'))
+    repoTuple = ('check', 'repo', 0)
+    lineLocalSuite = [metricFunction for metricFunction in suite if metricFunction in repoAnalysis.lineLocalMetrics]
+    try:
+        generateRepo(*repoTuple[:2], commits, files, fileLength=30, branchiness=0.3, seed=seed, specialPaths=0.3, crlf=0.2, missingNewlines=0.2)
+        with io.capture_output():
+            metricCache.clear()
+            absolute = repoAnalysis.calculateMetrics(repoTuple, suite)
+            metricCache.clear()
+            incremental = repoAnalysis.calculateAbsoluteMetrics(repoTuple, suite)
+            metricCache.clear()
+            blobDeltas = repoAnalysis.calculateDeltaMetrics(repoTuple, lineLocalSuite, hunks=False)
+            metricCache.clear()
+            hunkDeltas = repoAnalysis.calculateDeltaMetrics(repoTuple, lineLocalSuite, hunks=True)
+    finally:
+        repoLibrarian.setReposFolder(previousFolder)
+    return differences(absolute, incremental, 'a vs c') + differences(blobDeltas, hunkDeltas, 'blob vs hunks')
+
+def versionOf():
+    '''Git commit of the analysis code that is benchmarked, marked dirty if there are uncommitted changes'''
+    folder = os.path.dirname(os.path.abspath(__file__))
+    try:
+        version = subprocess.run(['git', '-C', folder, 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        version = 'unknown'
+    return version
+
+def runBenchmarks(output='benchmark.json', folder=None, repos=3, commits=200, files=40, fileLength=100, branchiness=0.1, seed=0, processes=(1, 2, 4), repeat=3):
+    '''
+    Generates `repos` synthetic repositories (in a temporary folder unless one is given), runs all harnesses on them, and saves the results with environment and parameters as json.
+    Returns the saved dict
+    '''
+    parameters = {'repos': repos, 'commits': commits, 'files': files, 'fileLength': fileLength, 'branchiness': branchiness, 'seed': seed, 'processes': list(processes), 'repeat': repeat}
+    folder = folder or tempfile.mkdtemp(prefix='benchmark_')
+    previousFolder = repoLibrarian.getReposFolder()
+    repoLibrarian.setReposFolder(os.path.join(folder, 'repos'))
+    try:
+        repoTuples = []
+        for number in range(repos):
+            generateRepo('bench', 'repo'+str(number), commits, files, fileLength, branchiness, seed=seed+number)
+            repoTuples.append(('bench', 'repo'+str(number), number))
+        works = list(map(workOf, repoTuples))
+        results = []
+        for repoTuple, work in zip(repoTuples, works):
+            results.append(benchmarkAbsolute(repoTuple, work))
+            results.append(benchmarkDelta(repoTuple, work))
+            results.append(benchmarkIncremental(repoTuple, work))
+            results += benchmarkMetrics(repoTuple, repeat=repeat)
+        results += benchmarkFullAnalysis(repoTuples, works, folder, processes)
+    finally:
+        repoLibrarian.setReposFolder(previousFolder)
+    report = {
+        'version': versionOf(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'parameters': parameters,
+        'work': dict(zip([repoTuple[1] for repoTuple in repoTuples], works)),
+        'results': results,
+    }
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    return report
+
+def compareResults(oldPath, newPath):
+    '''Prints the seconds of two benchmark result files side by side, a speedup above 1 means the new version is faster'''
+    def load(path):
+        with open(path) as file:
+            report = json.load(file)
+        return report, {(result['benchmark'], result.get('repo'), result.get('processes')): result['seconds'] for result in report['results']}
+    (oldReport, old), (newReport, new) = load(oldPath), load(newPath)
+    if oldReport['parameters'] != newReport['parameters']:
+        print('Warning: The benchmarks were run with different parameters')
+    print('benchmark'.ljust(40)+oldReport['version'].rjust(14)+newReport['version'].rjust(14)+'speedup'.rjust(10))
+    for key in sorted(old.keys() & new.keys(), key=str):
+        name = ' '.join(str(part) for part in key if part is not None)
+        print(name.ljust(40)+('%.4f' % old[key]).rjust(14)+('%.4f' % new[key]).rjust(14)+('%.2f' % (old[key] / new[key] if new[key] else 0)).rjust(10))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the repoAnalysis benchmarks on synthetic repositories, or compares two result files')
+    parser.add_argument('--output', default='benchmark.json', help='result file')
+    parser.add_argument('--folder', default=None, help='folder for generated repositories and databases, temporary by default')
+    parser.add_argument('--repos', type=int, default=3)
+    parser.add_argument('--commits', type=int, default=200)
+    parser.add_argument('--files', type=int, default=40)
+    parser.add_argument('--file-length', type=int, default=100)
+    parser.add_argument('--branchiness', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files instead of running benchmarks')
+    parser.add_argument('--check', action='store_true', help='check that approach c agrees with approach a and the hunk engine with the blob engine instead of running benchmarks')
+    args = parser.parse_args()
+    if args.compare:
+        compareResults(*args.compare)
+    elif args.check:
+        mismatches = checkApproaches(args.folder, seed=args.seed)
+        print('Approaches agree' if not mismatches else str(len(mismatches))+' mismatches, e.g. '+str(mismatches[:5]))
+        sys.exit(1 if mismatches else 0)
+    else:
+        runBenchmarks(args.output, args.folder, args.repos, args.commits, args.files, args.file_length, args.branchiness, args.seed, args.processes, args.repeat)
+        print('Saved results to '+args.output)
@@ -0,0 +1,96 @@
+'''
+This module makes analysis runs resumable and incremental.
+Per result table, metric suite, and repository it records in an SQLite file
+- the commits whose results have been written, so an interrupted repository continues where it stopped
+- the ref tips of the last complete analysis, so finished repositories are skipped and updated ones only analyze new commits (`git log <new tips> --not <known tips>`)
+Checkpoints are written by the writer process of the resultSink module after results have been written successfully, so they never claim results that are not in the target
+'''
+
+import hashlib
+
+import metricCache
+import connections
+
+'''Path of the checkpoint file, None disables checkpoints. Can be changed with accessors'''
+checkpointPath = None
+
+database = connections.SqliteFile([
+    'CREATE TABLE IF NOT EXISTS analyzed_commits (scope TEXT, repo_id INTEGER, sha TEXT, PRIMARY KEY (scope, repo_id, sha))',
+    'CREATE TABLE IF NOT EXISTS ref_tips (scope TEXT, repo_id INTEGER, tips TEXT, PRIMARY KEY (scope, repo_id))',
+    'CREATE TABLE IF NOT EXISTS pending_repos (scope TEXT, repo_id INTEGER, tips TEXT, done INTEGER, failed INTEGER, PRIMARY KEY (scope, repo_id))'])
+
+def setCheckpointPath(path):
+    '''Accessor to set (or with None to disable) the checkpoint file'''
+    global checkpointPath
+    checkpointPath = database.setPath(path)
+    return checkpointPath
+
+def getCheckpointPath():
+    '''The current checkpoint file, None if checkpoints are disabled'''
+    return checkpointPath
+
+def getConnection():
+    '''Connection to the checkpoint file, None if checkpoints are disabled'''
+    return database.get()
+
+def scopeOf(tableName, metricSuite, filters=None):
+    '''Checkpoints are kept apart per result table, metric suite, and commit filters (e.g. authors and dates), so a run to another table, with changed metrics, or with other filters starts from zero'''
+    scope = tableName + ':' + metricCache.suiteFingerprint(metricSuite)
+    if filters is not None and any(part is not None for part in filters):
+        scope = scope + ':' + hashlib.sha1(repr(filters).encode()).hexdigest()[:16]
+    return scope
+
+def refTips(repo):
+    '''Shas of all refs of a repository, i.e. the revisions that `--all` stands for'''
+    return sorted(set(repo.git.rev_parse('--all').split()))
+
+def knownTips(scope, repoId):
+    '''Ref tips of the last complete analysis of a repository, empty if it has never been finished'''
+    row = getConnection().execute('SELECT tips FROM ref_tips WHERE scope = ? AND repo_id = ?', (scope, repoId)).fetchone()
+    return row[0].split() if row else []
+
+def analyzedCommits(scope, repoId):
+    '''Set of commits of a repository whose results have already been written'''
+    return {sha for (sha,) in getConnection().execute('SELECT sha FROM analyzed_commits WHERE scope = ? AND repo_id = ?', (scope, repoId))}
+
+def resetPending(scope):
+    '''Forgets unfinished repositories of an earlier run; their written commits stay recorded, only the shards of the new run count towards finishing them'''
+    db = getConnection()
+    db.execute('DELETE FROM pending_repos WHERE scope = ?', (scope,))
+    db.commit()
+
+def markAnalyzed(scope, repoId, tips, data, written):
+    '''
+    Writer callback for a batch of results of a repository: records the commits of the batch if it has been written, otherwise marks the repository as failed so that it is not finished in this run
+    Does nothing for the end marker of a task (data None), see `markTaskDone`
+    '''
+    if data is None:
+        return
+    db = getConnection()
+    if written:
+        db.executemany('INSERT OR IGNORE INTO analyzed_commits VALUES (?, ?, ?)', [(scope, repoId, sha) for sha in data['sha']])
+    else:
+        db.execute('INSERT OR IGNORE INTO pending_repos VALUES (?, ?, ?, 0, 0)', (scope, repoId, ' '.join(tips)))
+        db.execute('UPDATE pending_repos SET failed = 1 WHERE scope = ? AND repo_id = ?', (scope, repoId))
+    db.commit()
+
+def markTaskDone(scope, repoId, tips, tasks, data, written):
+    '''Writer callback at the end of one of the `tasks` tasks (shards) of a repository; when all are done without failures, the tips are recorded as finished'''
+    db = getConnection()
+    db.execute('INSERT OR IGNORE INTO pending_repos VALUES (?, ?, ?, 0, 0)', (scope, repoId, ' '.join(tips)))
+    db.execute('UPDATE pending_repos SET done = done + 1 WHERE scope = ? AND repo_id = ?', (scope, repoId))
+    (done, failed) = db.execute('SELECT done, failed FROM pending_repos WHERE scope = ? AND repo_id = ?', (scope, repoId)).fetchone()
+    if done >= tasks and not failed:
+        db.execute('INSERT OR REPLACE INTO ref_tips VALUES (?, ?, ?)', (scope, repoId, ' '.join(tips)))
+        db.execute('DELETE FROM pending_repos WHERE scope = ? AND repo_id = ?', (scope, repoId))
+    db.commit()
+
+def clear(scope=None):
+    '''Removes all checkpoints of a scope (or of all scopes), so that the next run analyzes everything again'''
+    db = getConnection()
+    for table in ['analyzed_commits', 'ref_tips', 'pending_repos']:
+        if scope is None:
+            db.execute('DELETE FROM '+table)
+        else:
+            db.execute('DELETE FROM '+table+' WHERE scope = ?', (scope,))
+    db.commit()
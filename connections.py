@@ -0,0 +1,67 @@
+'''
+This small module keeps the connections to the local SQLite files of the metricCache, checkpoints, and queryCache modules, and the engines of the SQLAlchemy databases of result targets and the work queue.
+Connections are not shared between processes, so every process (e.g. a forked pool worker) opens its own on first use
+'''
+
+import os
+import sqlite3
+
+import sqlalchemy
+
+class SqliteFile:
+    '''Per process connection to an SQLite file in WAL mode; the given statements (e.g. `CREATE TABLE IF NOT EXISTS`) are run when a connection is opened'''
+
+    def __init__(self, statements):
+        self.statements = statements
+        self.path = None
+        self.connection = None
+        self.connectionPid = None
+
+    def setPath(self, path):
+        '''Switches to another file (or with None disables the connection), the file is created when it is first used'''
+        self.path = path
+        self.connection = None
+        self.connectionPid = None
+        return path
+
+    def get(self):
+        '''Connection of the current process, None if no file is set'''
+        if self.path is None:
+            return None
+        if self.connection is None or self.connectionPid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            for statement in self.statements:
+                self.connection.execute(statement)
+            self.connection.commit()
+            self.connectionPid = os.getpid()
+        return self.connection
+
+
+class SqlDatabase:
+    '''
+    SQLAlchemy database (with an optional schema) whose engine is created lazily per process.
+    Engines cannot be pickled, so they are left out when an object is passed to another process, which then creates its own
+    '''
+
+    def __init__(self, url, schema=None):
+        self.url = url
+        self.schema = schema
+        self._engine = None
+        self._enginePid = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, _engine=None, _enginePid=None)
+
+    @property
+    def engine(self):
+        if self._engine is None or self._enginePid != os.getpid():
+            # SQLite files are shared by several processes, e.g. the writers of local workers, which wait for each other instead of failing
+            isSqlite = sqlalchemy.engine.make_url(str(self.url)).get_backend_name() == 'sqlite'
+            self._engine = sqlalchemy.create_engine(self.url, connect_args={'timeout': 60} if isSqlite else {})
+            self._enginePid = os.getpid()
+        return self._engine
+
+    def qualified(self, tableName):
+        '''Table name with schema (if any) for use in queries'''
+        return self.schema+'.'+tableName if self.schema else tableName
@@ -0,0 +1,168 @@
+'''
+This module caches metric results of single source files so that every file version only has to be analyzed once.
+Git identifies each file version by its blob sha, so the sha together with a fingerprint of the metric suite is a stable key for its metric results.
+The cache has two layers:
+- An in-process LRU layer, which catches the common case of a blob being analyzed as new version in one commit and as parent version in the next one
+- An optional persistent layer in an SQLite file, which can be shared by all workers of a `runFullAnalysis` run (and by later runs with the same suite)
+Additionally, whole delta result rows are cached per commit sha. Forks and mirrors share most of their commits, so their shared commits only have to be analyzed once, see `deltaMetricsOfRepo`
+'''
+
+import json
+import inspect
+import hashlib
+import functools
+from collections import OrderedDict
+
+import connections
+
+'''Bump this when the format of cached values changes, it is part of every suite fingerprint'''
+cacheVersion = 1
+
+'''Sha of the empty blob, used for file versions that do not exist (e.g. the parent version of an added file)'''
+nullSha = '0' * 40
+
+'''Maximum number of entries of the in-process layer, each entry takes roughly a few hundred bytes'''
+maxEntries = 100000
+'''Number of new entries that are collected before they are written to the persistent layer'''
+flushInterval = 500
+
+'''Path of the persistent cache file, None disables the persistent layer. Can be changed with accessors'''
+cachePath = None
+
+memoryCache = OrderedDict()
+pendingEntries = []
+pendingCommits = []
+'''Fingerprints of the suites whose commit rows have been cached in this process'''
+commitFingerprints = set()
+database = connections.SqliteFile([
+    'CREATE TABLE IF NOT EXISTS blob_metrics (key TEXT PRIMARY KEY, metrics TEXT)',
+    'CREATE TABLE IF NOT EXISTS commit_metrics (key TEXT PRIMARY KEY, row TEXT)'])
+
+def setCachePath(path):
+    '''Accessor to set (or with None to disable) the persistent cache file; pending entries are written to the previous file first'''
+    global cachePath
+    flush()
+    cachePath = database.setPath(path)
+    return cachePath
+
+def getCachePath():
+    '''The current persistent cache file, None if only the in-process layer is used'''
+    return cachePath
+
+def sourceOf(function):
+    '''Source code of a metric function if available, name otherwise; used so that changing a metric function invalidates its cached results'''
+    try:
+        return inspect.getsource(function)
+    except (OSError, TypeError):
+        return function.__module__ + '.' + function.__qualname__
+
+@functools.lru_cache(maxsize=None)
+def fingerprintOf(metricTuple):
+    '''Memoized worker of `suiteFingerprint`, takes a tuple because lists are not hashable'''
+    fingerprint = hashlib.sha1(str(cacheVersion).encode())
+    for metricFunction in metricTuple:
+        fingerprint.update(metricFunction.__name__.encode())
+        fingerprint.update(sourceOf(metricFunction).encode())
+    return fingerprint.hexdigest()[:16]
+
+def suiteFingerprint(metricSuite):
+    '''Short hash over names and sources of all metric functions of a suite, identifies which results a cache entry holds'''
+    return fingerprintOf(tuple(metricSuite))
+
+def getConnection():
+    '''Connection to the persistent layer, None if it is disabled'''
+    return database.get()
+
+def remember(key, metrics):
+    '''Adds an entry to the in-process layer and evicts the least recently used entries'''
+    memoryCache[key] = metrics
+    memoryCache.move_to_end(key)
+    while len(memoryCache) > maxEntries:
+        memoryCache.popitem(last=False)
+
+def lookup(blobSha, fingerprint):
+    '''Returns the cached metric values of a blob as list in suite order, or None if the blob has not been analyzed with this suite yet'''
+    key = fingerprint + blobSha
+    metrics = memoryCache.get(key)
+    if metrics is not None:
+        memoryCache.move_to_end(key)
+        return metrics
+    db = getConnection()
+    if db is None:
+        return None
+    row = db.execute('SELECT metrics FROM blob_metrics WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    metrics = json.loads(row[0])
+    remember(key, metrics)
+    return metrics
+
+def store(blobSha, fingerprint, metrics):
+    '''Caches the metric values of a blob; entries for the persistent layer are written in batches'''
+    key = fingerprint + blobSha
+    remember(key, metrics)
+    if cachePath is not None:
+        pendingEntries.append((key, json.dumps(metrics)))
+        if len(pendingEntries) >= flushInterval:
+            flush()
+
+def lookupCommits(commitShas, fingerprint):
+    '''Returns the cached delta result rows (without sha and repo id, in column order) of those of the given commits that have already been analyzed with this suite, as dict by sha'''
+    rows = {}
+    missing = []
+    for commitSha in commitShas:
+        row = memoryCache.get('commit:' + fingerprint + commitSha)
+        if row is not None:
+            rows[commitSha] = row
+        else:
+            missing.append(commitSha)
+    db = getConnection()
+    if db is None:
+        return rows
+    for start in range(0, len(missing), 500):
+        keys = [fingerprint + commitSha for commitSha in missing[start:start+500]]
+        for key, row in db.execute('SELECT key, row FROM commit_metrics WHERE key IN ('+', '.join('?' * len(keys))+')', keys):
+            row = json.loads(row)
+            remember('commit:' + key, row)
+            rows[key[len(fingerprint):]] = row
+    return rows
+
+def mayHaveCommits(fingerprint):
+    '''Whether there can be cached commit rows of a suite, i.e. the persistent layer is set or rows have been cached in this process; if not, looking up commits can be skipped'''
+    return cachePath is not None or fingerprint in commitFingerprints
+
+def storeCommit(commitSha, fingerprint, row):
+    '''Caches the delta result row of a commit (without sha and repo id); entries for the persistent layer are written in batches'''
+    remember('commit:' + fingerprint + commitSha, row)
+    commitFingerprints.add(fingerprint)
+    if cachePath is not None:
+        pendingCommits.append((fingerprint + commitSha, json.dumps(row)))
+        if len(pendingCommits) >= flushInterval:
+            flush()
+
+def flush():
+    '''Writes pending entries to the persistent layer, should be called when a repository is done'''
+    if not pendingEntries and not pendingCommits:
+        return
+    db = getConnection()
+    if db is None:
+        pendingEntries.clear()
+        pendingCommits.clear()
+        return
+    db.executemany('INSERT OR IGNORE INTO blob_metrics VALUES (?, ?)', pendingEntries)
+    db.executemany('INSERT OR IGNORE INTO commit_metrics VALUES (?, ?)', pendingCommits)
+    db.commit()
+    pendingEntries.clear()
+    pendingCommits.clear()
+
+def clear():
+    '''Empties the in-process layer and, if set, the persistent layer'''
+    memoryCache.clear()
+    pendingEntries.clear()
+    pendingCommits.clear()
+    commitFingerprints.clear()
+    db = getConnection()
+    if db is not None:
+        db.execute('DELETE FROM blob_metrics')
+        db.execute('DELETE FROM commit_metrics')
+        db.commit()
@@ -0,0 +1,246 @@
+'''
+This module keeps results of `dbUtils.runQuery` on disk, so that long running queries (e.g. on GHTorrent) do not have to be run again after every kernel restart.
+Entries are keyed by the normalized query text (comments, whitespace, and case outside of quotes do not matter) and the database the query ran against.
+Results are stored as parquet files if pyarrow is installed, as pickled DataFrames otherwise; both load in a fraction of a second.
+An SQLite index in the cache folder keeps size, access time, expiry, and the tables each query reads from, so that
+- the least recently used entries are evicted when the folder exceeds `maxSize`
+- entries expire after their time to live, if one was given
+- entries are invalidated when a table they read from is written, created, or dropped (through `runQuery`, `createTable`, `deleteTable`, `writeDataToDb`, or the resultSink writer)
+Tables are matched by name without schema. Queries on views are not invalidated by writes to the underlying tables, use `tables` or a time to live for them
+'''
+
+import os
+import re
+import time
+import pickle
+import hashlib
+
+import pandas
+
+import connections
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+'''Folder of the cache, None disables caching. Can be changed with accessors'''
+cacheFolder = None
+'''Maximum size of all cached results in bytes, least recently used entries are evicted beyond it'''
+maxSize = 4 * 1024**3
+'''Time to live in seconds for entries that are stored without one, None keeps them until they are invalidated or evicted'''
+defaultTtl = None
+
+database = connections.SqliteFile([
+    'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, file TEXT, query TEXT, size INTEGER, created REAL, accessed REAL, expires REAL)',
+    'CREATE TABLE IF NOT EXISTS dependencies (key TEXT, table_name TEXT, PRIMARY KEY (key, table_name))',
+    'CREATE INDEX IF NOT EXISTS dependencies_table ON dependencies (table_name)'])
+
+def setCacheFolder(folder):
+    '''Accessor to set (or with None to disable) the cache folder, it is created if it does not exist yet'''
+    global cacheFolder
+    cacheFolder = folder
+    database.setPath(os.path.join(folder, 'index.sqlite') if folder is not None else None)
+    if folder is not None:
+        os.makedirs(folder, exist_ok=True)
+    return cacheFolder
+
+def getCacheFolder():
+    '''The current cache folder, None if caching is disabled'''
+    return cacheFolder
+
+def getConnection():
+    '''Connection to the index of the cache folder, None if caching is disabled'''
+    return database.get()
+
+# ===== Query analysis =====
+identifier = r'(?:"(?:[^"]|"")+"|[a-z_][\w$]*)'
+qualified = identifier + r'(?:\s*\.\s*' + identifier + r')*'
+tokenPattern = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/|\s+|[^'\"\s/-]+|[/-]", re.DOTALL)
+'''Keywords that can follow a table name, they are not taken as its alias'''
+keywords = ['join', 'left', 'right', 'inner', 'outer', 'full', 'cross', 'natural', 'lateral', 'on', 'using', 'where', 'group', 'having', 'window', 'order', 'limit', 'offset',
+    'fetch', 'for', 'union', 'intersect', 'except', 'returning', 'tablesample', 'as', 'select', 'values', 'set']
+alias = r'(?!(?:' + '|'.join(keywords) + r')\b)' + identifier
+readPattern = re.compile(r'\b(?:from|join)\s+(' + qualified + r'(?:\s+(?:as\s+)?' + alias + r')?(?:\s*,\s*' + qualified + r'(?:\s+(?:as\s+)?' + alias + r')?)*)')
+writePattern = re.compile(r'\b(?:insert\s+into|update|delete\s+from|truncate(?:\s+table)?|alter\s+table(?:\s+if\s+exists)?|refresh\s+materialized\s+view(?:\s+concurrently)?'
+    + r'|drop\s+(?:table|view|materialized\s+view)(?:\s+if\s+exists)?'
+    + r'|create\s+(?:or\s+replace\s+)?(?:(?:temp|temporary|unlogged)\s+)?(?:table|view|materialized\s+view)(?:\s+if\s+not\s+exists)?)\s+(' + qualified + r')')
+
+def normalize(query):
+    '''Query text without comments, with single spaces, and lower case outside of quotes, so that formatting changes do not miss the cache'''
+    parts = []
+    for token in tokenPattern.findall(query):
+        if token.startswith(("'", '"')):
+            parts.append(token)
+        elif token.startswith('--') or token.startswith('/*') or token.isspace():
+            parts.append(' ')
+        else:
+            parts.append(token.lower())
+    return re.sub(' +', ' ', ''.join(parts)).strip().rstrip(';').strip()
+
+def tableName(name):
+    '''Table name without schema and quotes, as used for invalidation'''
+    return re.split(r'\s*\.\s*', name.strip())[-1].strip('"').lower()
+
+def readTables(query):
+    '''Names of the tables (and views and CTEs) a query reads from'''
+    tables = set()
+    for match in readPattern.finditer(normalize(query)):
+        for item in match.group(1).split(','):
+            tables.add(tableName(re.match(qualified, item.strip()).group(0)))
+    return tables
+
+def checkReadTables():
+    '''Checks `readTables` on queries with and without aliases and joins, returns the `(query, found, expected)` triples that differ'''
+    checks = [
+        ('SELECT * FROM crm20.users JOIN crm20.lb_results3 ON users.id = lb_results3.user_id', {'users', 'lb_results3'}),
+        ('SELECT * FROM users u LEFT JOIN commits AS c ON u.id = c.author_id WHERE c.id > 0', {'users', 'commits'}),
+        ('SELECT * FROM a, b x, c AS y NATURAL JOIN d CROSS JOIN e', {'a', 'b', 'c', 'd', 'e'}),
+        ('SELECT * FROM users WHERE id IN (SELECT user_id FROM "Project Members" GROUP BY 1) ORDER BY id LIMIT 5', {'users', 'project members'}),
+        ('WITH r AS (SELECT * FROM lb_results3) SELECT * FROM r UNION SELECT * FROM lb_results2', {'lb_results3', 'r', 'lb_results2'})]
+    return [(query, readTables(query), expected) for query, expected in checks if readTables(query) != expected]
+
+def writtenTables(query):
+    '''Names of the tables a query creates, changes, or drops; empty for read only queries'''
+    return {tableName(match.group(1)) for match in writePattern.finditer(normalize(query))}
+
+def isCacheable(query):
+    '''Only read only queries are cached'''
+    normalized = normalize(query)
+    return normalized.startswith(('select', 'with', '(')) and not writtenTables(normalized)
+
+def keyOf(query, engine):
+    '''Key of a query: hash of the normalized text and the database url (without password)'''
+    return hashlib.sha1((repr(engine.url) + '\n' + normalize(query)).encode()).hexdigest()
+
+# ===== Entries =====
+def readResult(path):
+    '''Reads a result file written by `writeResult`'''
+    if path.endswith('.parquet'):
+        return pandas.read_parquet(path)
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+def writeResult(result, path):
+    '''Writes a result as parquet (if possible) or pickle file, returns the path used; files are written under a temporary name and then moved, so readers never see partial files'''
+    if pyarrow is not None:
+        try:
+            result.to_parquet(path + '.parquet.tmp', index=True)
+            os.replace(path + '.parquet.tmp', path + '.parquet')
+            return path + '.parquet'
+        except Exception:
+            # E.g. object columns with mixed types, which parquet cannot store
+            if os.path.exists(path + '.parquet.tmp'):
+                os.remove(path + '.parquet.tmp')
+    with open(path + '.pickle.tmp', 'wb') as file:
+        pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.pickle.tmp', path + '.pickle')
+    return path + '.pickle'
+
+def lookup(query, engine):
+    '''Returns the cached result of a query, or None if there is no valid entry'''
+    db = getConnection()
+    if db is None or not isCacheable(query):
+        return None
+    key = keyOf(query, engine)
+    row = db.execute('SELECT file, expires FROM entries WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    (file, expires) = row
+    if expires is not None and expires < time.time():
+        remove([key])
+        return None
+    try:
+        result = readResult(os.path.join(cacheFolder, file))
+    except Exception as e:
+        print('Dropping unreadable query cache entry '+file+': '+str(e))
+        remove([key])
+        return None
+    db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+    db.commit()
+    return result
+
+def store(query, engine, result, ttl=None, tables=()):
+    '''Caches the result of a read only query; `ttl` (seconds) defaults to `defaultTtl`, `tables` adds dependencies that cannot be seen in the query text'''
+    db = getConnection()
+    if db is None or not isCacheable(query):
+        return
+    key = keyOf(query, engine)
+    path = writeResult(result, os.path.join(cacheFolder, key))
+    ttl = ttl if ttl is not None else defaultTtl
+    now = time.time()
+    for stale in ['.parquet', '.pickle']:
+        if not path.endswith(stale) and os.path.exists(os.path.join(cacheFolder, key + stale)):
+            os.remove(os.path.join(cacheFolder, key + stale))
+    db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)', (key, os.path.basename(path), normalize(query), os.path.getsize(path), now, now, now + ttl if ttl is not None else None))
+    db.execute('DELETE FROM dependencies WHERE key = ?', (key,))
+    db.executemany('INSERT OR IGNORE INTO dependencies VALUES (?, ?)', [(key, table) for table in readTables(query) | set(map(tableName, tables))])
+    db.commit()
+    evict()
+
+def remove(keys):
+    '''Deletes entries with their files'''
+    db = getConnection()
+    keys = list(keys)
+    for key in keys:
+        row = db.execute('SELECT file FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is not None and os.path.exists(os.path.join(cacheFolder, row[0])):
+            os.remove(os.path.join(cacheFolder, row[0]))
+    db.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in keys])
+    db.executemany('DELETE FROM dependencies WHERE key = ?', [(key,) for key in keys])
+    db.commit()
+    return len(keys)
+
+def evict():
+    '''Removes expired entries and then the least recently used ones until the cache fits into `maxSize`'''
+    db = getConnection()
+    if db is None:
+        return 0
+    expired = [key for (key,) in db.execute('SELECT key FROM entries WHERE expires < ?', (time.time(),))]
+    evicted = []
+    total = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries WHERE expires IS NULL OR expires >= ?', (time.time(),)).fetchone()[0]
+    if total > maxSize:
+        for key, size in db.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+            if total <= maxSize:
+                break
+            if key not in expired:
+                evicted.append(key)
+                total = total - size
+    return remove(expired + evicted)
+
+# ===== Invalidation =====
+def invalidate(query, engine):
+    '''Explicitly removes the entry of a query'''
+    if getConnection() is None:
+        return 0
+    return remove([keyOf(query, engine)])
+
+def invalidateTables(tables):
+    '''Removes all entries that read from one of the given tables (names with or without schema)'''
+    db = getConnection()
+    if db is None:
+        return 0
+    names = list({tableName(table) for table in tables})
+    keys = {key for name in names for (key,) in db.execute('SELECT key FROM dependencies WHERE table_name = ?', (name,))}
+    return remove(keys)
+
+def invalidateWrites(query):
+    '''Removes all entries that read from a table the given query writes to'''
+    if getConnection() is None:
+        return 0
+    return invalidateTables(writtenTables(query))
+
+def clear():
+    '''Removes all entries'''
+    db = getConnection()
+    if db is None:
+        return 0
+    return remove([key for (key,) in db.execute('SELECT key FROM entries')])
+
+def summary():
+    '''Number of entries and their total size in bytes'''
+    db = getConnection()
+    if db is None:
+        return {'entries': 0, 'size': 0}
+    (entries, size) = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+    return {'entries': entries, 'size': size}
@@ -3,24 +3,31 @@ This module is the heart of this repository. It includes the functions that are
 It can be structured as follows:
 - The first part includes the regexes and wrapping metric functions that are used to analyze the contents of single source files. 
     All metric functions return numbers of occurences of structures in code, which can later be divided by loc to get unweighted density metrics
+    The fused scanner calculates all metrics of the default suite together on the raw bytes of a file, which is how files are analyzed during the runs
 - The second and third part include functions to analyze a set of metrics for all files of a repository. The two parts use different approaches:
     a) Calculating absolute metrics each commit (which means that all files are analyzed) (decently fast)
     b) Calculating only deltas for each commit (starkly fast)
+    c) Deriving the absolute metrics of a) from the changes of each commit (as fast as b)
 - The last part includes methods to run the metrics on a given set of repos and write the results to table; 
     the `runFullAnalysis` method uses all functionality of the parts above (apart from approach a))
+    `enqueueAnalysis` and `runAnalysisWorker` distribute such a run over several machines through a shared work queue
 '''
 
 import re
+import codecs
+import subprocess
 import repoLibrarian
 import time
 import pandas
 
-from git.util import hex_to_bin
-from git import Commit
-
 import functools
 import dbUtils
-from sqlalchemy import Column, Integer, String
+import metricCache
+import resultSink
+import checkpoints
+import telemetry
+import workQueue
+from sqlalchemy import Column, Integer, String, text
 import multiprocessing
 from multiprocessing import Pool
 from IPython.utils import io
@@ -102,7 +109,172 @@ Function names should be in snake case as they are later used to determine colum
 Functions should accept **kwargs and are passed contents of files in different formats (full, without header, without header, strings and comments)
 '''
 metricSuite = [loc, cloc, file_count, num_methods, num_lambdas, num_comment_lines, num_reflection, num_snakes, total_indent]
-   
+
+
+# ===== Fused scanner =====
+'''
+The fused scanner calculates all metric functions of the default suite at once and yields the same numbers as calling them one by one.
+It splits a source file once into header, strings, comments and code, and derives every metric from these parts with counting operations, so no line lists or further string copies are built.
+It works on the raw bytes of a blob, which saves the CP437 decode.
+This is only valid as long as bytes and decoded characters are matched the same way, which holds for ascii content without the file separator control characters (`\\x1c`-`\\x1f`, whitespace in python strings but not in bytes).
+All other files fall back to the decoded string, scanned by the same code.
+'''
+fusedMetrics = {loc, cloc, file_count, num_methods, num_lambdas, num_comment_lines, num_reflection, num_snakes, total_indent}
+
+fileSeparators = [b'\x1c', b'\x1d', b'\x1e', b'\x1f']
+'''Matches, in reversed content, a `(` that is preceded by `name (` with a type in front, and the run of word characters, brackets and whitespace in front of it'''
+reversedMethodHeaderRegex = re.compile(rb"\((?= *\w+\s+[\w\<\>\[\]])[\w\<\>\[\]\s]*")
+methodHeaderEndRegex = re.compile(rb"[^\)]*\) *\{?")
+bytesMethodRegex = re.compile(methodRegex.pattern.encode())
+
+def countMethodHeaders(content):
+    '''
+    Counts the matches of `methodRegex` in ascii bytes without trying the regex at every position: 
+    Each method header runs up to the first `(` after its start, which is preceded by a `type name` pair, and everything before consists of word characters, brackets and whitespace.
+    Searching the reversed content finds these parentheses quickly, as the regex starts with a literal. 
+    `methodRegex` is then only run from the start of the run in front of each of them up to the end of the header, which yields the same leftmost non-overlapping matches as `findall`
+    '''
+    count = 0
+    position = 0
+    for candidate in reversed(list(reversedMethodHeaderRegex.finditer(content[::-1]))):
+        parenthesis = len(content) - 1 - candidate.start()
+        if parenthesis < position:
+            continue
+        end = methodHeaderEndRegex.match(content, parenthesis + 1)
+        if end is None:
+            break
+        match = bytesMethodRegex.search(content, max(position, len(content) - candidate.end()), end.end())
+        if match is not None:
+            count = count + 1
+            position = match.end()
+    return count
+
+'''Matches an underscore with word characters on both sides, i.e. the middle of a match of `snakeRegex`'''
+snakeCenterRegex = re.compile(rb"_(?<=\w_)(?=\w)")
+bytesSnakeRegex = re.compile(snakeRegex.pattern.encode())
+
+def countSnakes(content):
+    '''
+    Counts the matches of `snakeRegex` in ascii bytes. Underscores are rare in most java code, so instead of trying the regex at every position, only underscores are visited.
+    Taking each snake whose start lies behind the end of the previously taken one yields the same non-overlapping matches as `findall`
+    '''
+    if content.count(b'_') * 32 > len(content):
+        return len(bytesSnakeRegex.findall(content))
+    count = 0
+    end = 0
+    for center in snakeCenterRegex.finditer(content):
+        if center.start() > end:
+            count = count + 1
+            end = center.start() + 2
+    return count
+
+def fusedDialect(literal, indentRegex, regexOf, methodCounter, snakeCounter):
+    '''Bundles literals, regexes and counters of the fused scanner for either bytes or strings, `literal` and `regexOf` convert the shared patterns'''
+    return {
+        'empty' : literal(''),
+        'newline' : literal('\n'),
+        'tab' : literal('\t'),
+        'headerEnd' : literal('{'),
+        'stringReplacement' : literal('"..."'),
+        'commentReplacement' : literal('/*...*/'),
+        'lambdaOperators' : [literal('->'), literal('::')],
+        'reflectionUsages' : [literal('instanceof'), literal('.class.'), literal('Class<')],
+        'stringRegex' : regexOf(stringRemoveRegex),
+        # Same as `commentRegex`, but separates oneline and multiline comments into groups when splitting (the shared `/` is kept outside the groups, so the regex can skip to it quickly)
+        'commentSplitRegex' : regexOf(re.compile(r"/(?:(/.*?\n)|(\*.*?\*/))", re.S)),
+        # Matches each line break with the indent of the following line
+        'indentRegex' : indentRegex,
+        'methodCounter' : methodCounter,
+        'snakeCounter' : snakeCounter
+    }
+
+bytesDialect = fusedDialect(lambda text: text.encode(), re.compile(rb"\n[\t\x0b\x0c\r ]*"), lambda regex: re.compile(regex.pattern.encode(), regex.flags & re.S), countMethodHeaders, countSnakes)
+stringDialect = fusedDialect(lambda text: text, re.compile(r"\n[^\S\n]*"), lambda regex: regex, functools.partial(occurencesOf, methodRegex), functools.partial(occurencesOf, snakeRegex))
+
+def fusedScan(contentWithHeader, dialect):
+    '''Calculates all fused metrics of a file, given as bytes or string with the matching dialect, and returns them by metric name. The expensive metrics are timed as telemetry stages'''
+    newline = dialect['newline']
+    with telemetry.stage('strip'):
+        content = contentWithHeader.split(dialect['headerEnd'], 1)
+        content = content[1] if len(content) > 1 else dialect['empty']
+        # Parts alternate between code, oneline comment, and multiline comment, the comment not found is None
+        parts = dialect['commentSplitRegex'].split(dialect['stringRegex'].sub(dialect['stringReplacement'], content))
+        onelineComments = parts[1::3]
+        multilineComments = parts[2::3]
+        contentWithoutComments = dialect['commentReplacement'].join(parts[0::3])
+    contentLines = content.count(newline) + 1
+    # Oneline comments count as one line each, multiline comments as one more than the line breaks they include (they do not end with whitespace, so stripping them is not necessary)
+    commentLines = len(onelineComments) - onelineComments.count(None) + len(multilineComments) - multilineComments.count(None)
+    commentLines = commentLines + dialect['empty'].join(filter(None, multilineComments)).count(newline)
+    with telemetry.stage('metric:num_methods'):
+        methods = dialect['methodCounter'](content)
+    with telemetry.stage('metric:num_snakes'):
+        snakes = dialect['snakeCounter'](contentWithoutComments)
+    with telemetry.stage('metric:total_indent'):
+        indents = dialect['empty'].join(dialect['indentRegex'].findall(newline + content))
+    return {
+        'loc' : contentWithHeader.count(newline) + 1,
+        'cloc' : contentLines,
+        'file_count' : 1 if contentWithHeader else 0,
+        'num_methods' : methods,
+        'num_lambdas' : sum(map(content.count, dialect['lambdaOperators'])),
+        'num_comment_lines' : commentLines,
+        'num_reflection' : sum(map(contentWithoutComments.count, dialect['reflectionUsages'])),
+        'num_snakes' : snakes,
+        'total_indent' : (len(indents) - contentLines + 3 * indents.count(dialect['tab'])) / 4
+    }
+
+def fusedScanBytes(data):
+    '''Calculates all fused metrics of a raw file, only decodes it if it contains bytes that would be matched differently'''
+    if data.isascii() and not any(map(data.__contains__, fileSeparators)):
+        return fusedScan(data, bytesDialect)
+    with telemetry.stage('decode'):
+        content = data.decode("CP437")
+    return fusedScan(content, stringDialect)
+
+def metricsOfBytes(metricSuite, data):
+    '''
+    Calculates a metric suite for the raw content of a file and returns the occurences as list in suite order.
+    Metrics of the default suite are taken from the fused scanner, all other metric functions are called as usual with the decoded content (see `metricsOfContent`)
+    '''
+    fused = fusedScanBytes(data) if any(metricFunction in fusedMetrics for metricFunction in metricSuite) else {}
+    others = [metricFunction for metricFunction in metricSuite if metricFunction not in fusedMetrics]
+    if others:
+        with telemetry.stage('decode'):
+            content = data.decode("CP437")
+        others = dict(zip(others, metricsOfContent(others, content)))
+    return [fused[metricFunction.__name__] if metricFunction in fusedMetrics else others[metricFunction] for metricFunction in metricSuite]
+
+
+# ===== Line-local metrics =====
+'''
+Line-local metrics are sums over single lines, so their deltas can be calculated from the added and removed lines of a diff alone (see `hunkDeltaMetricsForChanges`).
+Each is declared with its scope, 'file' for all lines of a file or 'body' for the lines after the header (see `removeHeader`), and a function that sums it up over a list of lines given as bytes (without line breaks).
+All other metrics are whole-file metrics, as they depend on context: comments, method headers spanning lines, or, like `num_snakes` and `num_reflection`, content with (multiline) comments removed
+'''
+def lambdasOfLines(lines):
+    '''`num_lambdas` of lines, the operators cannot span line breaks'''
+    content = b'\n'.join(lines)
+    return content.count(b'->') + content.count(b'::')
+
+def indentOfLines(lines):
+    '''`total_indent` of lines like the fused scanner; lines are decoded if the fused scanner would decode a file with them (see `fusedScanBytes`), as more characters count as whitespace then'''
+    if not lines:
+        return 0
+    content = b'\n'.join(lines)
+    if content.isascii() and not any(map(content.__contains__, fileSeparators)):
+        indents = b''.join(bytesDialect['indentRegex'].findall(b'\n' + content))
+        return (len(indents) - len(lines) + 3 * indents.count(b'\t')) / 4
+    indents = ''.join(stringDialect['indentRegex'].findall('\n' + content.decode("CP437")))
+    return (len(indents) - len(lines) + 3 * indents.count('\t')) / 4
+
+lineLocalMetrics = {
+    loc : ('file', len),
+    cloc : ('body', len),
+    num_lambdas : ('body', lambdasOfLines),
+    total_indent : ('body', indentOfLines)
+}
+
 
 # ===== a) Absolute occurences approach - Analysis code for Iteration #1 ===== 
 def calculateMetrics(repoTuple, metricSuite=metricSuite):
@@ -120,6 +292,7 @@ def calculateMetrics(repoTuple, metricSuite=metricSuite):
         for commit in repo.iter_commits('--all'):
             results.append(metricsForCommit(commit, metricSuite, repoId))
         df = pandas.DataFrame(results, columns=columns)
+        metricCache.flush()
         end = time.time()
         print('Time used for '+str(repoTuple)+': '+str(end - start))
         return df
@@ -139,13 +312,7 @@ def metricsForCommit(commit, metricSuite, repoId):
         resultTuple[metricFunction.__name__] = 0
     for obj in commit.tree.traverse():
         if obj.type == 'blob' and obj.name.endswith('.java'):
-            contentWithHeader = obj.data_stream.read().decode("CP437")#.decode("utf-8")
-            content = removeHeader(contentWithHeader)
-            contentWithoutStrings = stringRemoveRegex.sub("\"...\"", content)
-            contentWithoutComments = commentRegex.sub("/*...*/", contentWithoutStrings)
-            for metricFunction in metricSuite:
-                metric = metricFunction(content=content, contentWithHeader=contentWithHeader, contentWithoutComments=contentWithoutComments)
-                resultTuple[metricFunction.__name__] = resultTuple[metricFunction.__name__] + metric
+            addMetricValuesTo(metricSuite, metricsOfBlob(metricSuite, obj), resultTuple)
     return resultTuple
     
 
@@ -164,25 +331,113 @@ def block_to_stats(block):
     deletions = sum(map(lambda file: safeToInt(file[1]), changed_files))
     return (header, (changed_files, additions, deletions))
 
+def unquotePath(path):
+    '''Path of a raw or numstat line as named in the repository: git quotes paths with special characters (e.g. non-ascii letters, which it writes as octal escapes of their utf-8 bytes)'''
+    if not path.startswith('"'):
+        return path
+    return codecs.escape_decode(path[1:-1].encode('utf-8', 'surrogateescape'))[0].decode('utf-8', 'surrogateescape')
+
+def sideOf(path, sha, mode):
+    '''One side of a changed file in a raw diff: its blob sha, or the null sha if the file does not exist or is no java file (submodules are no files)'''
+    return sha if path.endswith('.java') and mode != '160000' else metricCache.nullSha
+
+def block_to_changes(block):
+    '''
+    Splits one block of commit data into old and new blob sha of each changed java file, assumes a git log raw and numstat format (see `deltaMetricsOfRepo`)
+    Raw and numstat lines list the files in the same order. A file counts as java file if its old or its new path ends with `.java`, renames are paired by git
+    '''
+    lines = block.split('\n')
+    header = lines[0]
+    raw = [line[1:].split('\t') for line in lines[1:] if line.startswith(':')]
+    numstat = [line.split('\t') for line in lines[1:] if line and not line.startswith(':')]
+    changed_files = []
+    additions = 0
+    deletions = 0
+    for (meta, *paths), (added, removed, *display) in zip(raw, numstat):
+        oldMode, newMode, oldSha, newSha, status = meta.split(' ')
+        oldPath, newPath = unquotePath(paths[0]), unquotePath(paths[-1])
+        if oldPath.endswith('.java') or newPath.endswith('.java'):
+            changed_files.append((added, removed, sideOf(oldPath, oldSha, oldMode), sideOf(newPath, newSha, newMode)))
+            additions = additions + safeToInt(added)
+            deletions = deletions + safeToInt(removed)
+    return (header, (changed_files, additions, deletions))
+
 def file_contents(tree, path):
     '''Safely gets file contents in a git tree, if the file is not existent, it has been deleted'''
+    blob = file_blob(tree, path)
+    return blob.data_stream.read().decode("CP437") if blob is not None else ''
+
+def file_blob(tree, path):
+    '''Safely gets the blob of a file in a git tree, None if the file is not existent'''
     try: 
-        obj = tree / path
-        return obj.data_stream.read().decode("CP437")
+        return tree / path
     except KeyError:
-        return ''
+        return None
+
+def metricsOfContent(metricSuite, contentWithHeader):
+    '''Calls all functions of a metric suite on full file content, without header, and without comments and returns the occurences as list in suite order'''
+    with telemetry.stage('strip'):
+        content = removeHeader(contentWithHeader)
+        contentWithoutStrings = stringRemoveRegex.sub("\"...\"", content)
+        contentWithoutComments = commentRegex.sub("/*...*/", contentWithoutStrings)
+    if not telemetry.isEnabled():
+        return [metricFunction(content=content, contentWithHeader=contentWithHeader, contentWithoutComments=contentWithoutComments) for metricFunction in metricSuite]
+    metrics = []
+    for metricFunction in metricSuite:
+        with telemetry.stage('metric:'+metricFunction.__name__):
+            metrics.append(metricFunction(content=content, contentWithHeader=contentWithHeader, contentWithoutComments=contentWithoutComments))
+    return metrics
+
+def metricsOfBlob(metricSuite, blob):
+    '''
+    Like `metricsOfBytes`, but for a git blob (None for non-existent files). 
+    Results are cached by blob sha, so each file version is only decoded and analyzed once per metric suite, see the metricCache module
+    '''
+    fingerprint = metricCache.suiteFingerprint(metricSuite)
+    blobSha = blob.hexsha if blob is not None else metricCache.nullSha
+    metrics = metricCache.lookup(blobSha, fingerprint)
+    if metrics is None:
+        with telemetry.stage('blobFetch'):
+            data = blob.data_stream.read() if blob is not None else b''
+        telemetry.count('blobs')
+        telemetry.count('bytes', len(data))
+        metrics = metricsOfBytes(metricSuite, data)
+        metricCache.store(blobSha, fingerprint, metrics)
+    else:
+        telemetry.count('cacheHits')
+    return metrics
+
+def metricsOfShas(metricSuite, shas, catFile):
+    '''
+    Like `metricsOfBlob`, but for many blobs given by sha at once, returns a dict from sha to metric values.
+    Blobs that are not cached yet are read in bulk through a `repoLibrarian.CatFile`
+    '''
+    fingerprint = metricCache.suiteFingerprint(metricSuite)
+    metrics = {}
+    for sha in shas:
+        metrics[sha] = metricCache.lookup(sha, fingerprint)
+    missing = [sha for sha, values in metrics.items() if values is None]
+    with telemetry.stage('blobFetch'):
+        contents = catFile.read([sha for sha in missing if sha != metricCache.nullSha]) if missing else {}
+    telemetry.count('cacheHits', len(metrics) - len(missing))
+    telemetry.count('blobs', len(contents))
+    telemetry.count('bytes', sum(map(len, contents.values())))
+    for sha in missing:
+        metrics[sha] = metricsOfBytes(metricSuite, contents.get(sha, b''))
+        metricCache.store(sha, fingerprint, metrics[sha])
+    return metrics
+
+def addMetricValuesTo(metricSuite, metrics, resultTuple, factor=1):
+    '''Weightedly adds metric values (in suite order) to an existing sum'''
+    for metricFunction, metric in zip(metricSuite, metrics):
+        resultTuple[metricFunction.__name__] = resultTuple[metricFunction.__name__] + metric * factor
     
 def addMetricsOfTo(metricSuite, contentWithHeader, resultTuple, factor=1):
     '''
     Calls all functions of a metric suite on full file content, without header, and without comments and weightedly adds the occurences to an existing sum 
     Used to aggregate for each file of a commit, weighting can be used to subtract the parent commit data, thus effectively calculating delta.
     '''
-    content = removeHeader(contentWithHeader)
-    contentWithoutStrings = stringRemoveRegex.sub("\"...\"", content)
-    contentWithoutComments = commentRegex.sub("/*...*/", contentWithoutStrings)
-    for metricFunction in metricSuite:
-        metric = metricFunction(content=content, contentWithHeader=contentWithHeader, contentWithoutComments=contentWithoutComments)
-        resultTuple[metricFunction.__name__] = resultTuple[metricFunction.__name__] + metric * factor
+    addMetricValuesTo(metricSuite, metricsOfContent(metricSuite, contentWithHeader), resultTuple, factor)
 
 def deltaMetricsForCommit(commit, metricSuite, repoId, change):
     '''
@@ -202,68 +457,756 @@ def deltaMetricsForCommit(commit, metricSuite, repoId, change):
         resultTuple[metricFunction.__name__] = 0
         
     for added, removed, file in changed_files:
-        addMetricsOfTo(metricSuite, file_contents(commit.tree,            file), resultTuple    )
-        addMetricsOfTo(metricSuite, file_contents(commit.parents[0].tree, file), resultTuple, -1)
+        addMetricValuesTo(metricSuite, metricsOfBlob(metricSuite, file_blob(commit.tree,            file)), resultTuple    )
+        addMetricValuesTo(metricSuite, metricsOfBlob(metricSuite, file_blob(commit.parents[0].tree, file)), resultTuple, -1)
             
     return resultTuple
     
 
-def calculateDeltaMetrics(repoTuple, metricSuite=metricSuite):
+def deltaMetricsForChanges(header, metricSuite, repoId, change, catFile):
+    '''
+    Like `deltaMetricsForCommit`, but takes commit data and blob shas from a raw log block (see `block_to_changes`), so neither commit objects nor trees have to be read
+    '''
+    changed_files, additions, deletions = change
+    hexsha, timestamp, parent = header.split()
+
+    resultTuple = {
+        'sha' : hexsha,
+        'parent' : parent,
+        'timestamp' : int(timestamp),
+        'repo_id' : repoId,
+        'additions' : additions,
+        'deletions' : deletions
+    }
+    for metricFunction in metricSuite:
+        resultTuple[metricFunction.__name__] = 0
+
+    metrics = metricsOfShas(metricSuite, {sha for added, removed, oldSha, newSha in changed_files for sha in (oldSha, newSha)}, catFile)
+    for added, removed, oldSha, newSha in changed_files:
+        addMetricValuesTo(metricSuite, metrics[newSha], resultTuple    )
+        addMetricValuesTo(metricSuite, metrics[oldSha], resultTuple, -1)
+
+    return resultTuple
+
+'''
+Git log options of the hunk engine: raw and numstat as for the blob engine, plus patches without context lines, as only changed lines are needed.
+Commits are visited oldest first, so header lines of files are known from the patches that added them (see `hunkDeltaMetricsForChanges`)
+'''
+hunkLogOptions = ['--raw', '--numstat', '-p', '-U0', '--no-color', '--no-ext-diff', '--no-textconv', '--reverse']
+'''Cache fingerprint of the header line of blobs, see `headerLinesOf`'''
+headerFingerprint = 'header-line'
+hunkHeaderRegex = re.compile(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+def usesHunks(metricSuite):
+    '''Whether deltas of a suite are calculated with the hunk engine by default: only if all of its metrics are line-local, otherwise full file versions have to be analyzed anyway'''
+    return all(metricFunction in lineLocalMetrics for metricFunction in metricSuite)
+
+def parsePatch(lines):
+    '''
+    Parses the patch of one file (from `-U0` output) into its hunks as `(oldStart, oldCount, newStart, newCount)`, the removed and added lines as bytes, and whether the old and new versions end without line break.
+    Returns None for binary files
+    '''
+    patch = {'hunks': [], 'removed': [], 'added': [], 'oldNoNewline': False, 'newNoNewline': False}
+    previous = None
+    for line in lines:
+        if line.startswith('@@'):
+            oldStart, oldCount, newStart, newCount = hunkHeaderRegex.match(line).groups()
+            patch['hunks'].append((int(oldStart), 1 if oldCount is None else int(oldCount), int(newStart), 1 if newCount is None else int(newCount)))
+        elif not patch['hunks']:
+            if line.startswith('Binary files ') or line.startswith('GIT binary patch'):
+                return None
+        elif line.startswith('-'):
+            patch['removed'].append(line[1:].encode('utf-8', 'surrogateescape'))
+        elif line.startswith('+'):
+            patch['added'].append(line[1:].encode('utf-8', 'surrogateescape'))
+        elif line.startswith('\\'):
+            patch['oldNoNewline' if previous == '-' else 'newNoNewline'] = True
+        previous = line[:1]
+    return patch
+
+def block_to_hunks(block):
+    '''
+    Like `block_to_changes`, but for a log with patches (see `hunkLogOptions`): each changed java file additionally carries its parsed patch.
+    Patches follow raw and numstat lines in the same order; if they cannot be matched, all patches are None and the blob engine is used for the commit
+    '''
+    start = block.find('\ndiff --git ')
+    (header, (changed_files, additions, deletions)) = block_to_changes(block if start < 0 else block[:start+1])
+    raw = [line[1:].split('\t') for line in block[:None if start < 0 else start].split('\n')[1:] if line.startswith(':')]
+    sections = []
+    if start >= 0:
+        for line in block[start+1:].rstrip('\n').split('\n'):
+            if line.startswith('diff --git '):
+                sections.append([])
+            else:
+                sections[-1].append(line)
+    if len(sections) != len(raw):
+        sections = [None] * len(raw)
+    patches = []
+    for (meta, *paths), lines in zip(raw, sections):
+        if unquotePath(paths[0]).endswith('.java') or unquotePath(paths[-1]).endswith('.java'):
+            patch = parsePatch(lines) if lines is not None else None
+            if patch is not None:
+                patch['status'] = meta.split(' ')[4][0]
+            patches.append(patch)
+    return (header, ([change + (patch,) for change, patch in zip(changed_files, patches)], additions, deletions))
+
+def headerLinesOf(shas, catFile):
+    '''
+    Index of the line with the first `{` (where `removeHeader` cuts off the header) for each of the given blobs, -1 if there is none.
+    Results are cached like metrics, and only the header has to be scanned
+    '''
+    lines = {sha: metricCache.lookup(sha, headerFingerprint) for sha in shas}
+    missing = [sha for sha, line in lines.items() if line is None]
+    if missing:
+        with telemetry.stage('blobFetch'):
+            contents = catFile.read(missing)
+        telemetry.count('headerBlobs', len(contents))
+        telemetry.count('headerBytes', sum(map(len, contents.values())))
+        for sha in missing:
+            data = contents.get(sha, b'')
+            end = data.find(b'{')
+            lines[sha] = [data.count(b'\n', 0, end) if end >= 0 else -1]
+            metricCache.store(sha, headerFingerprint, lines[sha])
+    return {sha: line[0] for sha, line in lines.items()}
+
+def headerLineOfLines(lines):
+    '''Like `headerLinesOf`, but for a file version given as its lines'''
+    return next((index for index, line in enumerate(lines) if b'{' in line), -1)
+
+def lineMetricsOfLines(lineSuite, lines, noNewline):
+    '''
+    Line-local metrics of a full file version given as its lines, e.g. the added lines of an added file.
+    Like the metric functions, this counts the empty line after a final line break and the rest of the header line behind the `{` as first line of the body
+    '''
+    headerLine = headerLineOfLines(lines)
+    final = [] if noNewline else [b'']
+    metrics = []
+    for metricFunction in lineSuite:
+        (scope, linesMetric) = lineLocalMetrics[metricFunction]
+        if scope == 'file':
+            metrics.append(linesMetric(lines + final))
+        elif headerLine < 0:
+            metrics.append(linesMetric([b'']))
+        else:
+            metrics.append(linesMetric([lines[headerLine].split(b'{', 1)[1]] + lines[headerLine+1:] + final))
+    return metrics
+
+def rememberHeaderLines(change):
+    '''Caches the header lines of the files added by a commit without results (a root commit), so later changes of them can be calculated from patches'''
+    for added, removed, oldSha, newSha, patch in change[0]:
+        if patch is not None and patch['status'] == 'A' and patch['hunks']:
+            metricCache.store(newSha, headerFingerprint, [headerLineOfLines(patch['added'])])
+
+def firstChangedLine(hunks, side):
+    '''First line (1-based) of the old (side 0) or new (side 1) version that is changed or in front of which lines are inserted'''
+    return min(start if count > 0 else start + 1 for start, count in (hunk[2*side:2*side+2] for hunk in hunks))
+
+def keepsHeader(headerLine, hunks, side):
+    '''Whether all changes of a file lie behind the line with the first `{`, so that header and body are split at the same place in both versions'''
+    return headerLine is not None and headerLine >= 0 and firstChangedLine(hunks, side) > headerLine + 1
+
+def hunkDeltaMetricsForChanges(header, metricSuite, repoId, change, catFile):
+    '''
+    Like `deltaMetricsForChanges`, but calculates line-local metrics (see `lineLocalMetrics`) from the added and removed lines of the patches (see `block_to_hunks`), so unchanged lines are never scanned.
+    Changes of the final line break are accounted for, as metrics count the empty line after a final line break.
+    Body metrics additionally require the header to be unchanged, which is checked with the cached header line of the old or new version (see `headerLinesOf`).
+    Added and deleted files are analyzed from their patches, which contain them completely.
+    Whole-file metrics, as well as binary files, files that change their type, and files whose header changes, are calculated from the full file versions like in `deltaMetricsForChanges`
+    '''
+    changed_files, additions, deletions = change
+    hexsha, timestamp, parent = header.split()
+
+    resultTuple = {
+        'sha' : hexsha,
+        'parent' : parent,
+        'timestamp' : int(timestamp),
+        'repo_id' : repoId,
+        'additions' : additions,
+        'deletions' : deletions
+    }
+    for metricFunction in metricSuite:
+        resultTuple[metricFunction.__name__] = 0
+
+    lineSuite = [metricFunction for metricFunction in metricSuite if metricFunction in lineLocalMetrics]
+    fileSuite = [metricFunction for metricFunction in metricSuite if metricFunction not in lineLocalMetrics]
+    needsHeader = any(lineLocalMetrics[metricFunction][0] == 'body' for metricFunction in lineSuite)
+    hunkFiles = []
+    blobFiles = []
+    wholeFiles = []
+    for added, removed, oldSha, newSha, patch in changed_files:
+        if oldSha == newSha:
+            continue
+        if patch is None or not patch['hunks']:
+            blobFiles.append((oldSha, newSha))
+        elif patch['status'] == 'A' and oldSha == metricCache.nullSha:
+            wholeFiles.append((newSha, patch['added'], patch['newNoNewline'], 1))
+        elif patch['status'] == 'D' and newSha == metricCache.nullSha:
+            wholeFiles.append((oldSha, patch['removed'], patch['oldNoNewline'], -1))
+        elif metricCache.nullSha in (oldSha, newSha):
+            blobFiles.append((oldSha, newSha))
+        else:
+            hunkFiles.append((oldSha, newSha, patch))
+
+    # Added and deleted files are completely in their patches, which are compared to empty files (like the null sha in the blob engine)
+    if wholeFiles:
+        emptyMetrics = lineMetricsOfLines(lineSuite, [], False)
+        with telemetry.stage('hunks'):
+            for sha, lines, noNewline, factor in wholeFiles:
+                telemetry.count('hunkBytes', sum(map(len, lines)))
+                metricCache.store(sha, headerFingerprint, [headerLineOfLines(lines)])
+                addMetricValuesTo(lineSuite, [metric - empty for metric, empty in zip(lineMetricsOfLines(lineSuite, lines, noNewline), emptyMetrics)], resultTuple, factor)
+        if fileSuite:
+            metrics = metricsOfShas(fileSuite, {sha for sha, lines, noNewline, factor in wholeFiles} | {metricCache.nullSha}, catFile)
+            for sha, lines, noNewline, factor in wholeFiles:
+                addMetricValuesTo(fileSuite, metrics[sha], resultTuple, factor)
+                addMetricValuesTo(fileSuite, metrics[metricCache.nullSha], resultTuple, -factor)
+
+    if needsHeader and hunkFiles:
+        # The header is kept if it is kept according to either version, in which case both versions have the same header line
+        known = {}
+        for oldSha, newSha, patch in hunkFiles:
+            for sha, side in [(newSha, 1), (oldSha, 0)]:
+                headerLine = metricCache.lookup(sha, headerFingerprint)
+                if headerLine is not None and keepsHeader(headerLine[0], patch['hunks'], side):
+                    known[oldSha] = headerLine[0]
+        headerLines = headerLinesOf({oldSha for oldSha, newSha, patch in hunkFiles if oldSha not in known}, catFile)
+        keptHeader = []
+        for oldSha, newSha, patch in hunkFiles:
+            headerLine = known.get(oldSha, headerLines.get(oldSha))
+            if keepsHeader(headerLine, patch['hunks'], 0):
+                keptHeader.append((oldSha, newSha, patch))
+                metricCache.store(newSha, headerFingerprint, [headerLine])
+            else:
+                blobFiles.append((oldSha, newSha))
+        hunkFiles = keptHeader
+
+    telemetry.count('hunkFiles', len(hunkFiles) + len(wholeFiles))
+    with telemetry.stage('hunks'):
+        for oldSha, newSha, patch in hunkFiles:
+            telemetry.count('hunkBytes', sum(map(len, patch['added'])) + sum(map(len, patch['removed'])))
+            finalLineBreaks = patch['oldNoNewline'] - patch['newNoNewline']
+            for metricFunction in lineSuite:
+                linesMetric = lineLocalMetrics[metricFunction][1]
+                delta = linesMetric(patch['added']) - linesMetric(patch['removed']) + finalLineBreaks * linesMetric([b''])
+                resultTuple[metricFunction.__name__] = resultTuple[metricFunction.__name__] + delta
+
+    if fileSuite and hunkFiles:
+        metrics = metricsOfShas(fileSuite, {sha for oldSha, newSha, patch in hunkFiles for sha in (oldSha, newSha)}, catFile)
+        for oldSha, newSha, patch in hunkFiles:
+            addMetricValuesTo(fileSuite, metrics[newSha], resultTuple    )
+            addMetricValuesTo(fileSuite, metrics[oldSha], resultTuple, -1)
+    if blobFiles:
+        metrics = metricsOfShas(metricSuite, {sha for files in blobFiles for sha in files}, catFile)
+        for oldSha, newSha in blobFiles:
+            addMetricValuesTo(metricSuite, metrics[newSha], resultTuple    )
+            addMetricValuesTo(metricSuite, metrics[oldSha], resultTuple, -1)
+
+    return resultTuple
+
+def logBlocks(repo, *args, stdin=None):
+    '''
+    Streams the output of a git log with `//` in front of each commit (see `calculateDeltaMetrics`) and yields one block of commit data at a time.
+    In contrast to splitting the full log, memory stays flat no matter how long the history is, and processing starts with the first commit
+    Revisions can also be passed as list on stdin (`--stdin`), e.g. many single commits with `--no-walk`
+    '''
+    if stdin is None:
+        process = repo.git.log(*args, as_process=True)
+    else:
+        process = repo.git.log(*args, '--stdin', as_process=True, istream=subprocess.PIPE)
+        # git reads all revisions before it starts to write, so stdin can be written completely first
+        process.stdin.write(''.join(revision+'\n' for revision in stdin).encode())
+        process.stdin.close()
+    lines = []
+    for line in process.stdout:
+        line = line.decode('utf-8', 'surrogateescape')
+        if line.startswith('//'):
+            if lines:
+                yield ''.join(lines)
+            lines = [line[2:]]
+        elif lines:
+            lines.append(line)
+    if lines:
+        yield ''.join(lines)
+    process.wait()
+
+'''Number of commits that are looked up in the metricCache module at a time before the missing ones are logged, see `deltaMetricsOfRepo`'''
+commitChunkSize = 5000
+
+def commitChunks(repo, *args, reverse=False):
+    '''
+    Streams the commits of a rev-list in chunks of `commitChunkSize`, as pairs of the non-merge commits with parent and the root commits of each chunk.
+    With `reverse`, the chunks go from the oldest commits to the newest
+    '''
+    process = repo.git.rev_list('--parents', *(['--reverse'] if reverse else []), *args, as_process=True)
+    commits = []
+    roots = []
+    for line in process.stdout:
+        shas = line.decode().split()
+        if len(shas) == 2:
+            commits.append(shas[0])
+        elif len(shas) == 1:
+            roots.append(shas[0])
+        if len(commits) + len(roots) >= commitChunkSize:
+            yield commits, roots
+            commits = []
+            roots = []
+    if commits or roots:
+        yield commits, roots
+    process.wait()
+
+def deltaMetricsOfRepo(repo, metricSuite, repoId, commitRange=None, revisions=None, exclude=None, hunks=None):
+    '''
+    Lazily calculates deltas of occurence metrics for all non-merge commits of a repository, yields one result tuple per commit
+    The raw diff of each commit includes old and new blob sha of every changed file, so contents are read by sha from one cat-file process (and only if not cached)
+    A commit range `(skip, count)` restricts the analysis to a slice of the log (count None for all remaining commits), used to split large repositories into shards
+    Revisions to log default to `--all`, e.g. `<new tips> --not <known tips>` only analyzes new commits; commits in the exclude set are skipped
+    Results of commits that have already been analyzed with the same suite, e.g. in another fork of the project, are taken from the metricCache module and only tagged with the repo id.
+    If the cache can hold such results, commits are listed with rev-list and looked up in chunks (see `commitChunks`), and only the missing ones of each chunk are logged (by sha with `--no-walk`), so their diffs are not computed again
+    Suites of only line-local metrics are calculated from patches with the hunk engine, see `hunkDeltaMetricsForChanges`; `hunks` forces (True) or disables (False) it
+    '''
+    hunks = usesHunks(metricSuite) if hunks is None else hunks
+    logOptions = hunkLogOptions if hunks else ['--raw', '--numstat']
+    toChanges = block_to_hunks if hunks else block_to_changes
+    forChanges = hunkDeltaMetricsForChanges if hunks else deltaMetricsForChanges
+    revisions = ['--all'] if revisions is None else revisions
+    exclude = exclude or set()
+    rangeArgs = []
+    if commitRange is not None:
+        (skip, count) = commitRange
+        rangeArgs = ['--skip='+str(skip)] + ([] if count is None else ['--max-count='+str(count)])
+    fingerprint = metricCache.suiteFingerprint(metricSuite)
+    columns = deltaColumns(metricSuite)
+    def analyze(log, catFile):
+        for header, change in telemetry.timedIterator('gitLog', map(toChanges, log)):
+            if hunks and len(header.split()) == 2:
+                rememberHeaderLines(change)
+            if len(header.split()) == 3 and header.split()[0] not in exclude:
+                telemetry.count('commits')
+                resultTuple = forChanges(header, metricSuite, repoId, change, catFile)
+                metricCache.storeCommit(resultTuple['sha'], fingerprint, [resultTuple[column] for column in columns if column not in ('sha', 'repo_id')])
+                yield resultTuple
+    with repoLibrarian.CatFile(repo) as catFile:
+        # note the `//%H`, `//` is a safe delimiter as it cannot occur in file paths on unix, macos, or windows; merges and root commits have no diff and are skipped by the parent count
+        if not metricCache.mayHaveCommits(fingerprint):
+            yield from analyze(logBlocks(repo, *logOptions, '--no-abbrev', '--format=//%H %ct %P', *rangeArgs, *revisions), catFile)
+            return
+        # The hunk engine visits commits from the oldest, so that header lines are passed on from earlier versions
+        for commits, roots in commitChunks(repo, *rangeArgs, *revisions, reverse=hunks):
+            with telemetry.stage('reuseLookup'):
+                candidates = [commitSha for commitSha in commits if commitSha not in exclude]
+                reused = metricCache.lookupCommits(candidates, fingerprint)
+            for commitSha, row in reused.items():
+                telemetry.count('reusedCommits')
+                yield dict(zip(columns, [commitSha, row[0], row[1], repoId] + row[2:]))
+            missing = [commitSha for commitSha in roots + candidates if commitSha not in reused]
+            if missing:
+                # `--reverse` of the hunk engine reverses the given order, so the oldest first chunk is given newest first
+                yield from analyze(logBlocks(repo, *logOptions, '--no-abbrev', '--format=//%H %ct %P', '--no-walk=unsorted', stdin=missing[::-1] if hunks else missing), catFile)
+
+def commitFilter(authors=None, since=None, until=None):
+    '''
+    Git log options that restrict an analysis to commits of given authors and a window of commit dates, so commits of other authors are never read; to be put in front of the revisions.
+    Authors are matched as fixed strings ignoring case, emails (anything with an `@`) exactly as `<email>`, other identities (e.g. names) as part of the author name.
+    Dates can be anything git understands (e.g. `'2019-01-01'`) or datetime objects; `since` is inclusive, `until` exclusive at second precision like in git.
+    Authors None means no author filter, while an empty list matches no commits; git has no option for that, so None is returned and callers skip the analysis
+    '''
+    options = []
+    if authors is not None:
+        if not authors:
+            return None
+        options += ['--author=' + ('<'+author+'>' if '@' in author else author) for author in authors]
+        options += ['--fixed-strings', '--regexp-ignore-case']
+    if since is not None:
+        options.append('--since=' + str(since))
+    if until is not None:
+        options.append('--until=' + str(until))
+    return options
+
+def authorsOf(repoTuple, authors):
+    '''Authors to filter a repository by: `authors` is either one list for all repos or a dict by repo id (or (user, project)), repos missing in the dict are not filtered and repos with an empty list have no matching commits'''
+    if not isinstance(authors, dict):
+        return authors
+    return authors.get(repoTuple[2], authors.get(tuple(repoTuple[:2])))
+
+def deltaColumns(metricSuite):
+    '''Column names of delta results for a given metric suite'''
+    return ['sha', 'parent', 'timestamp', 'repo_id', 'additions', 'deletions'] + list(map(lambda fun: fun.__name__, metricSuite))
+
+def calculateDeltaMetrics(repoTuple, metricSuite=metricSuite, authors=None, since=None, until=None, hunks=None):
     '''
     Calculates deltas of occurence metrics for all commits of one repository 
     Passed metric functions should fulfill the limitations described for `metricSuite`
     Commit iterator is created with git log, as delta information can addtionally derived on the fly
+    Optionally only commits of the given authors and/or in a date window are analyzed, see `commitFilter`
+    The engine (hunks for line-local suites, full file versions otherwise) is chosen automatically unless `hunks` is given, see `deltaMetricsOfRepo`
     '''
     (user, project, repoId) = repoTuple
+    options = commitFilter(authors, since, until)
+    if options is None:
+        return pandas.DataFrame([], columns=deltaColumns(metricSuite))
     repo = repoLibrarian.getRepo(user, project)
-    columns = ['sha', 'parent', 'timestamp', 'repo_id', 'additions', 'deletions'] + list(map(lambda fun: fun.__name__, metricSuite))
-    results = []
     try:
         start = time.time()
-        log = repo.git.log('--numstat', '--format=//%H', '--all')# note the `//%H`, `//` is a safe delimiter as it cannot occur in file paths on unix, macos, or windows 
-        commits = log.split('//')[1:]#First 'part' is empty string before the first commit
-        changes = map(block_to_stats, commits)
-
-        for hexsha, change in changes:
-            commit = Commit(repo, hex_to_bin(hexsha))
-            if len(commit.parents) == 1:
-                results.append(deltaMetricsForCommit(commit, metricSuite, repoId, change))
-                
-        df = pandas.DataFrame(results, columns=columns)
+        revisions = options + ['--all']
+        df = pandas.DataFrame(list(deltaMetricsOfRepo(repo, metricSuite, repoId, revisions=revisions, hunks=hunks)), columns=deltaColumns(metricSuite))
+        metricCache.flush()
         end = time.time()
         print('Time used for '+str(repoTuple)+': '+str(end - start))
         return df
     except Exception as e:
         print('Failed to analyze '+str(repoTuple)+': '+str(e))
         return []
+
+def streamDeltaMetrics(repoTuple, sink, metricSuite=metricSuite, batchSize=5000, commitRange=None, revisions=None, exclude=None):
+    '''
+    Streaming version of `calculateDeltaMetrics` for long histories: Results are passed to the sink (a function taking a dataframe, e.g. a partial of `dbUtils.writeDataToDb`) in batches of at most `batchSize` rows while the log is still being read.
+    Optionally only analyzes a commit range `(skip, count)` of the log, given revisions, and commits not excluded, see `deltaMetricsOfRepo`.
+    Records one telemetry record for the repository (if enabled, see the telemetry module).
+    Returns the number of rows that have been passed to the sink, None if the analysis failed
+    '''
+    (user, project, repoId) = repoTuple
+    repo = repoLibrarian.getRepo(user, project)
+    columns = deltaColumns(metricSuite)
+    name = str(repoTuple) + ('' if commitRange is None else ' commits '+str(commitRange))
+    def emit(batch):
+        with telemetry.stage('dataFrame'):
+            data = pandas.DataFrame(batch, columns=columns)
+        with telemetry.stage('sink'):
+            sink(data)
+        return len(batch)
+    rows = 0
+    batch = []
+    with telemetry.recorded('repo', tuple(repoTuple), commitRange=commitRange):
+        try:
+            start = time.time()
+            for result in deltaMetricsOfRepo(repo, metricSuite, repoId, commitRange, revisions, exclude):
+                batch.append(result)
+                if len(batch) >= batchSize:
+                    rows = rows + emit(batch)
+                    batch = []
+            if batch:
+                rows = rows + emit(batch)
+            metricCache.flush()
+            end = time.time()
+            print('Time used for '+name+': '+str(end - start))
+        except Exception as e:
+            print('Failed to analyze '+name+': '+str(e))
+            return None
+    return rows
     
+# ===== c) Incremental absolute occurences approach ===== 
+def block_to_sides(block):
+    '''Splits one block of commit data into old and new blob sha of each changed java file, assumes a git log raw format without renames (see `absoluteMetricsOfRepo`)'''
+    lines = block.split('\n')
+    header = lines[0]
+    sides = []
+    for line in lines[1:]:
+        if line.startswith(':'):
+            meta, path = line[1:].split('\t', 1)
+            path = unquotePath(path)
+            oldMode, newMode, oldSha, newSha, status = meta.split(' ')
+            if path.endswith('.java'):
+                sides.append((sideOf(path, oldSha, oldMode), sideOf(path, newSha, newMode)))
+    return (header, sides)
+
+def firstParentChildren(repo, *revisions):
+    '''Counts for each commit the commits that have it as first parent, i.e. how often its totals are needed in `absoluteMetricsOfRepo`'''
+    children = {}
+    for line in repo.git.rev_list('--parents', *revisions).split('\n'):
+        shas = line.split()
+        if len(shas) > 1:
+            children[shas[1]] = children.get(shas[1], 0) + 1
+    return children
+
+def absoluteMetricsOfRepo(repo, metricSuite, repoId):
+    '''
+    Lazily calculates the same per commit project totals as `calculateMetrics` (approach a) for all commits of a repository, merges included, without scanning whole trees.
+    Commits are visited in topological order from the roots, so the totals of the first parent are always known: each commit adds the metrics of the new versions and subtracts those of the old versions of the java files changed against its first parent (the empty tree for roots).
+    As all metrics are sums over files, this carries the state of every path forward; files that do not exist count 0.
+    Totals of a commit are only kept until all commits with it as first parent are done. Requires git 2.31 or later for `--diff-merges`
+    '''
+    zero = [0] * len(metricSuite)
+    children = firstParentChildren(repo, '--all')
+    totals = {}
+    with repoLibrarian.CatFile(repo) as catFile:
+        log = logBlocks(repo, '--raw', '--no-abbrev', '--no-renames', '--root', '--diff-merges=first-parent', '--topo-order', '--reverse', '--format=//%H %ct %P', '--all')
+        for header, sides in telemetry.timedIterator('gitLog', map(block_to_sides, log)):
+            hexsha, timestamp, *parents = header.split()
+            current = list(totals[parents[0]]) if parents else list(zero)
+            if parents:
+                children[parents[0]] = children[parents[0]] - 1
+                if children[parents[0]] == 0:
+                    del totals[parents[0]]
+            metrics = metricsOfShas(metricSuite, {sha for side in sides for sha in side if sha != metricCache.nullSha}, catFile)
+            for oldSha, newSha in sides:
+                for index, (new, old) in enumerate(zip(metrics.get(newSha, zero), metrics.get(oldSha, zero))):
+                    current[index] = current[index] + new - old
+            if children.get(hexsha, 0) > 0:
+                totals[hexsha] = current
+            telemetry.count('commits')
+            resultTuple = {
+                'sha' : hexsha,
+                'parent' : parents[0] if len(parents) == 1 else None,
+                'timestamp' : int(timestamp),
+                'repo_id' : repoId
+            }
+            for metricFunction, metric in zip(metricSuite, current):
+                resultTuple[metricFunction.__name__] = metric
+            yield resultTuple
+
+def calculateAbsoluteMetrics(repoTuple, metricSuite=metricSuite):
+    '''
+    Incremental version of `calculateMetrics`: Calculates full project metric results for each commit of a repository at the cost of the delta approach, see `absoluteMetricsOfRepo`.
+    Returns them in form of a Pandas Dataframe with the same columns as `calculateMetrics`
+    '''
+    (user, project, repoId) = repoTuple
+    repo = repoLibrarian.getRepo(user, project)
+    columns = ['sha', 'parent', 'timestamp', 'repo_id'] + list(map(lambda fun: fun.__name__, metricSuite))
+    try:
+        start = time.time()
+        df = pandas.DataFrame(absoluteMetricsOfRepo(repo, metricSuite, repoId), columns=columns)
+        metricCache.flush()
+        end = time.time()
+        print('Time used for '+str(repoTuple)+': '+str(end - start))
+        return df
+    except Exception as e:
+        print('Failed to analyze '+str(repoTuple)+': '+str(e))
+        return []
+
+
+# ===== Scheduling =====
+'''Weights of the cost estimate: Work grows with the number of commits, commits of repos with many java files tend to touch more of them, and the pack size accounts for large files'''
+javaFilesPerCommitWeight = 1/1000
+packKiloBytesPerCommit = 256
+
+def estimateCost(repoTuple, scope=None, authors=None, since=None, until=None, pin=False):
+    '''
+    Estimates the analysis cost of a repository up front from commit count, pack size, and number of `.java` paths at HEAD, all of which git reports without reading the history.
+    With a checkpoint scope (see the checkpoints module), only commits that are not reachable from the tips of the last complete analysis are counted and the revisions to analyze are set accordingly.
+    Author and date filters (see `commitFilter` and `authorsOf`) become part of the revisions, so only matching commits are counted, sharded, and analyzed.
+    With `pin`, the revisions are the current ref tips instead of `--all`, so that the repository is analyzed at this state even by other machines, see `enqueueAnalysis`.
+    Repos without commits to analyze are not measured further and cost 0.
+    Returns a dict of the measures, the estimated `cost` in (roughly) commit units, the current ref `tips`, and the `revisions` to analyze; repos that cannot be read are estimated with cost 0 and revisions None, repos without matching authors with no revisions
+    '''
+    (user, project, repoId) = repoTuple
+    estimate = {'commits': 0, 'packSize': 0, 'javaFiles': 0, 'cost': 0, 'tips': None, 'revisions': None}
+    options = commitFilter(authorsOf(repoTuple, authors), since, until)
+    if options is None:
+        estimate['revisions'] = []
+        return estimate
+    try:
+        repo = repoLibrarian.getRepo(user, project)
+        revisions = ['--all']
+        if scope is not None or pin:
+            estimate['tips'] = checkpoints.refTips(repo)
+            knownTips = checkpoints.knownTips(scope, repoId) if scope is not None else []
+            revisions = estimate['tips'] + (['--not'] + knownTips if knownTips else [])
+        revisions = options + revisions
+        estimate['commits'] = int(repo.git.rev_list('--count', *revisions)) if estimate['tips'] != [] else 0
+        estimate['revisions'] = revisions
+        if estimate['commits'] == 0:
+            # Nothing to analyze (e.g. a finished repo of a resumed run), so the tree at HEAD is not listed
+            return estimate
+        counts = dict(line.split(': ') for line in repo.git.count_objects('-v').splitlines())
+        estimate['packSize'] = int(counts['size-pack']) + int(counts['size'])
+        estimate['javaFiles'] = sum(1 for path in repo.git.ls_tree('--full-tree', '--name-only', '-r', 'HEAD').split('\n') if path.endswith('.java'))
+    except Exception as e:
+        print('Failed to estimate '+str(repoTuple)+': '+str(e))
+    estimate['cost'] = estimate['commits'] * (1 + estimate['javaFiles'] * javaFilesPerCommitWeight) + estimate['packSize'] / packKiloBytesPerCommit
+    return estimate
+
+def planTasks(repos, estimates, processes, maxShare=1/2, minShardCommits=1000):
+    '''
+    Turns repositories into analysis tasks `(repoTuple, commitRange, estimate)` sorted largest-first; repos without commits to analyze (e.g. finished ones) get no task.
+    Repos that cost more than `maxShare` of the work of one process are split into commit ranges of the log (at least `minShardCommits` commits each), which different workers analyze in parallel and which together cover every commit once.
+    Together with largest-first dispatch this bounds the run by about total work divided by processes instead of by the slowest repo.
+    The number of tasks of a repo is stored as `shards` in its estimate
+    '''
+    totalCost = sum(estimate['cost'] for estimate in estimates)
+    maxTaskCost = max(1, totalCost / processes * maxShare)
+    tasks = []
+    for repo, estimate in zip(repos, estimates):
+        commits = estimate['commits']
+        if estimate['revisions'] is not None and commits == 0:
+            continue
+        shards = min(processes, int(-(-estimate['cost'] // maxTaskCost)), commits // minShardCommits)
+        estimate['shards'] = max(1, shards)
+        if shards <= 1:
+            tasks.append((estimate['cost'], repo, None, estimate))
+            continue
+        bounds = [commits * shard // shards for shard in range(shards + 1)]
+        for skip, end in zip(bounds, bounds[1:]):
+            # The last range is open ended so that commits added since the estimate are not lost
+            tasks.append((estimate['cost'] * (end - skip) / commits, repo, (skip, end - skip if end < commits else None), estimate))
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    return [(repo, commitRange, estimate) for cost, repo, commitRange, estimate in tasks]
+
 # ===== Suite running code for future iterations ===== 
-def runFullAnalysis(repos, tableName, repoFolder, logfile='log.txt', suite=metricSuite, loadFactor=3/4):
+def runFullAnalysis(repos, tableName, repoFolder, logfile='log.txt', suite=metricSuite, loadFactor=3/4, cachePath=None, target=None, checkpointPath=None, processes=None, telemetryPath=None, profileRepos=(), authors=None, since=None, until=None):
     '''
     Fully runs all functions of a metric suite for all repositories and writes the results to database (parallelizes mutliple runs of `runDeltaSuite`)
     Uses the delta approach for each commit of each repo.
     Creates a log file because of the large run time
+    A cache path can be given to share metric results of already analyzed file versions between workers and runs, see the metricCache module
+    Results are written by a single writer process to the given target (see the resultSink module), by default the dbUtils database via COPY
+    Repos are dispatched largest-first by estimated cost and very large repos are split into commit ranges, see `planTasks`
+    With a checkpoint path, the run can be resumed after a crash and repeated after repos have been updated: finished repos are skipped and only new commits are analyzed, see the checkpoints module
+    The number of worker processes defaults to the load factor times the number of cpus
+    With a telemetry path, stage times and counters are recorded per repo as JSON lines and aggregated for the run, the given (user, project) repos are profiled, see the telemetry module
+    Authors (one list for all repos or a dict by repo id) and a date window restrict the analysis to matching commits inside git, see `commitFilter`; checkpoints are kept apart per filter
     '''
-    createResultTable(tableName, suite)
+    target = target or resultSink.PostgresTarget()
+    target.createTable(tableName, resultColumns(suite))
     repoLibrarian.setReposFolder(repoFolder)
+    metricCache.setCachePath(cachePath)
+    checkpoints.setCheckpointPath(checkpointPath)
+    telemetry.configure(telemetryPath, profileRepos)
+    scope = None
+    if checkpointPath is not None:
+        scope = checkpoints.scopeOf(tableName, suite, (authors, since, until))
+        checkpoints.resetPending(scope)
     start = time.time()
-    with Pool(int(multiprocessing.cpu_count()*loadFactor)) as pool:
-        allMetrics = pool.map(functools.partial(runDeltaSuite, tableName=tableName, logfile=logfile, suite=suite), repos)
+    processes = processes or max(1, int(multiprocessing.cpu_count()*loadFactor))
+    queue, writer = resultSink.startWriter(target, logfile)
+    with Pool(processes, initializer=resultSink.attach, initargs=(queue,)) as pool:
+        estimates = pool.map(functools.partial(estimateCost, scope=scope, authors=authors, since=since, until=until), repos)
+        tasks = planTasks(repos, estimates, processes)
+        dbUtils.log('Planned '+str(len(tasks))+' tasks for '+str(len({tuple(task[0]) for task in tasks}))+' of '+str(len(repos))+' repos, estimated cost '+str(sum(estimate['cost'] for estimate in estimates)), logfile)
+        allMetrics = {}
+        for repo, rows in pool.imap_unordered(functools.partial(runDeltaTask, tableName=tableName, logfile=logfile, suite=suite, scope=scope), tasks, chunksize=1):
+            allMetrics[tuple(repo)] = allMetrics.get(tuple(repo), False) or bool(rows)
+        # Workers have to end normally instead of being terminated, so they flush their last batches to the queue
+        pool.close()
+        pool.join()
+    resultSink.stopWriter(queue, writer)
     end = time.time()
+    dbUtils.log('Results for '+str(sum(allMetrics.values()))+' of '+str(len(allMetrics))+' analyzed repos', logfile)
+    summary = telemetry.recordRun(end - start, tableName=tableName, processes=processes)
+    if summary is not None:
+        dbUtils.log('Telemetry of repos: '+telemetry.formatSummary(summary['repo'])+'\nTelemetry of writer: '+telemetry.formatSummary(summary['writer']), logfile)
     dbUtils.log('Total Time used: '+str(end - start), logfile)
     
-def runDeltaSuite(repo, tableName, logfile='log.txt', suite=metricSuite):
+def runDeltaSuite(repo, tableName, logfile='log.txt', suite=metricSuite, commitRange=None, revisions=None, exclude=None, checkpoint=None):
     '''
-    Runs all functions of a metric suite for a single repository and writes the results to database
+    Runs all functions of a metric suite for a single repository (or a part of its commits, see `streamDeltaMetrics`) and writes the results to database (through the writer process if one is attached)
+    The checkpoint callback is passed on with every batch, see `resultSink.push`. Returns the number of result rows, None if the analysis failed
     '''
     with io.capture_output() as output:
-        data = calculateDeltaMetrics(repo, suite)
-        dbUtils.writeDataToDb(data, tableName)
+        rows = streamDeltaMetrics(repo, functools.partial(resultSink.push, tableName=tableName, checkpoint=checkpoint), suite, commitRange=commitRange, revisions=revisions, exclude=exclude)
     dbUtils.log(output, logfile)
-    return len(data) > 0
+    return rows
+
+def runDeltaTask(task, tableName, logfile='log.txt', suite=metricSuite, scope=None):
+    '''
+    Runs a task `(repoTuple, commitRange, estimate)` of `planTasks`, returns the repo with its number of result rows so shards can be merged back per repo
+    With a checkpoint scope, written commits are recorded and already written ones are skipped; the end of the task is recorded after its last batch
+    '''
+    (repo, commitRange, estimate) = task
+    if scope is None or estimate['tips'] is None:
+        return repo, runDeltaSuite(repo, tableName, logfile, suite, commitRange, estimate['revisions'])
+    repoId = repo[2]
+    checkpoint = functools.partial(checkpoints.markAnalyzed, scope, repoId, estimate['tips'])
+    rows = runDeltaSuite(repo, tableName, logfile, suite, commitRange, estimate['revisions'], checkpoints.analyzedCommits(scope, repoId), checkpoint)
+    if rows is not None:
+        resultSink.push(None, tableName, functools.partial(checkpoints.markTaskDone, scope, repoId, estimate['tips'], estimate['shards']))
+    return repo, rows
+
+def resultColumns(suite=metricSuite):
+    '''Columns of a result table for a given metric suite, column names are chosen by metric function names'''
+    columns = [Column('sha', String), Column('parent', String), Column('timestamp', Integer), Column('repo_id', Integer), Column('additions', Integer), Column('deletions', Integer)]
+    return columns + list(map(lambda func: Column(func.__name__, Integer), suite))
 
 def createResultTable(tableName, suite=metricSuite):
     '''Creates a new database for a given metric suite, column names are chosen by metric function names'''
-    columns = [Column('sha', String), Column('parent', String), Column('timestamp', Integer), Column('repo_id', Integer), Column('additions', Integer), Column('deletions', Integer)]
-    columns = columns + list(map(lambda func: Column(func.__name__, Integer), suite))
-    dbUtils.createTable(tableName, columns)
\ No newline at end of file
+    dbUtils.createTable(tableName, resultColumns(suite))
+
+# ===== Distributed runs =====
+def enqueueAnalysis(repos, tableName, repoFolder, queueUrl, runId=None, logfile='log.txt', suite=metricSuite, processes=None, target=None, queueSchema=None, leaseSeconds=workQueue.defaultLeaseSeconds, maxAttempts=workQueue.defaultMaxAttempts, authors=None, since=None, until=None, loadFactor=3/4):
+    '''
+    Coordinator of a run that is distributed over several machines: creates the result table, estimates and plans the tasks of all repositories like `runFullAnalysis`, and puts them as work items into the queue tables of the given database (see the workQueue module)
+    `processes` is the number of worker processes of all machines together, large repos are split into commit ranges for it; it defaults to the processes of this machine
+    Revisions are pinned to the current ref tips, so all machines analyze the same commits; their repos folders have to contain the repositories at least at this state (missing ones are downloaded)
+    Returns the id of the run, which workers are started with, see `runAnalysisWorker`
+    '''
+    target = target or resultSink.PostgresTarget()
+    target.createTable(tableName, resultColumns(suite))
+    repoLibrarian.setReposFolder(repoFolder)
+    runId = runId or time.strftime('%Y-%m-%dT%H:%M:%S')+'-'+tableName
+    processes = processes or max(1, int(multiprocessing.cpu_count()*loadFactor))
+    with Pool(max(1, int(multiprocessing.cpu_count()*loadFactor))) as pool:
+        estimates = pool.map(functools.partial(estimateCost, authors=authors, since=since, until=until, pin=True), repos)
+    tasks = planTasks(repos, estimates, processes)
+    workQueue.WorkQueue(queueUrl, queueSchema).enqueue(runId, tableName, metricCache.suiteFingerprint(suite), tasks, leaseSeconds, maxAttempts)
+    dbUtils.log('Enqueued '+str(len(tasks))+' tasks for '+str(len({tuple(task[0]) for task in tasks}))+' of '+str(len(repos))+' repos as run '+runId+', estimated cost '+str(sum(estimate['cost'] for estimate in estimates)), logfile)
+    return runId
+
+def runAnalysisWorker(queueUrl, runId, repoFolder, logfile='log.txt', suite=metricSuite, loadFactor=3/4, processes=None, cachePath=None, target=None, queueSchema=None, telemetryPath=None, profileRepos=(), pollSeconds=10):
+    '''
+    Worker of a distributed run, to be started on every analysis machine (or several times on one machine): claims work items of the run from the queue and analyzes them with `processes` worker processes until no items are left
+    Results are written by one writer process per machine to the target (by default the dbUtils database via COPY), which completes the items after their results have been written
+    The leases of the items of the machine are extended by heartbeats; items of machines that stopped are claimed again after their lease and failed ones are retried, skipping commits whose results are already in the result table
+    Metric suite must be the one the run was enqueued with. Cache path and telemetry work like in `runFullAnalysis`, per machine
+    '''
+    queue = workQueue.WorkQueue(queueUrl, queueSchema)
+    run = queue.run(runId)
+    if run is None or run['suite'] != metricCache.suiteFingerprint(suite):
+        print('Run '+runId+(' does not exist' if run is None else ' has been enqueued with another metric suite'))
+        return None
+    target = target or resultSink.PostgresTarget()
+    repoLibrarian.setReposFolder(repoFolder)
+    metricCache.setCachePath(cachePath)
+    telemetry.configure(telemetryPath, profileRepos)
+    owner = workQueue.ownerId()
+    start = time.time()
+    processes = processes or max(1, int(multiprocessing.cpu_count()*loadFactor))
+    writerQueue, writer = resultSink.startWriter(target, logfile)
+    with Pool(processes, initializer=resultSink.attach, initargs=(writerQueue,)) as pool:
+        # Heartbeats continue until the writer has finished, as items are only completed after their results have been written
+        with workQueue.Heartbeat(queue, runId, owner, run['leaseSeconds']):
+            items = pool.map(functools.partial(runQueuedTasks, queue=queue, runId=runId, owner=owner, run=run, target=target, logfile=logfile, suite=suite, pollSeconds=pollSeconds), range(processes), chunksize=1)
+            pool.close()
+            pool.join()
+            resultSink.stopWriter(writerQueue, writer)
+    end = time.time()
+    dbUtils.log('Worker '+owner+' analyzed '+str(sum(items))+' work items of run '+runId+', queue: '+str(queue.summary(runId)), logfile)
+    summary = telemetry.recordRun(end - start, tableName=run['tableName'], processes=processes, workRun=runId)
+    if summary is not None:
+        dbUtils.log('Telemetry of repos: '+telemetry.formatSummary(summary['repo'])+'\nTelemetry of writer: '+telemetry.formatSummary(summary['writer']), logfile)
+    dbUtils.log('Total Time used: '+str(end - start), logfile)
+    return sum(items)
+
+def runQueuedTasks(index, queue, runId, owner, run, target, logfile='log.txt', suite=metricSuite, pollSeconds=10):
+    '''
+    Main loop of a worker process of `runAnalysisWorker`: claims and runs tasks (see `runDeltaTask`) until the run has no claimable items left, returns the number of claimed items.
+    While items are still held by other workers, it waits and tries again, as they are claimable again if their machine stops
+    '''
+    tableName = run['tableName']
+    items = 0
+    while True:
+        claimed = None
+        try:
+            claimed = queue.claim(runId, owner, run['leaseSeconds'], run['maxAttempts'])
+            if claimed is None and not queue.isRunning(runId, run['maxAttempts']):
+                return items
+        except Exception as e:
+            print('Failed to claim a work item of run '+runId+': '+str(e))
+        if claimed is None:
+            time.sleep(pollSeconds)
+            continue
+        (itemId, token, attempt, (repo, commitRange, estimate)) = claimed
+        # Whatever happens, the item has to be finished, as the heartbeats of the machine would keep it claimed otherwise
+        try:
+            exclude = writtenCommits(target, tableName, repo[2]) if attempt > 1 else None
+            rows = runDeltaSuite(repo, tableName, logfile, suite, commitRange, estimate['revisions'], exclude, functools.partial(workQueue.markItemWritten, queue, itemId, token))
+        except Exception as e:
+            print('Failed to run work item '+str(itemId)+' of run '+runId+': '+str(e))
+            rows = None
+        resultSink.push(None, tableName, functools.partial(workQueue.markItemDone, queue, itemId, token, rows))
+        items = items + 1
+
+def writtenCommits(target, tableName, repoId):
+    '''Commits of a repository that already have results in the result table of a target, so a retried work item does not write them again; empty for targets that cannot be read (csv)'''
+    if not isinstance(target, resultSink.SqlTarget):
+        return set()
+    with target.engine.connect() as connection:
+        return {sha for (sha,) in connection.execute(text('SELECT sha FROM '+target.qualified(tableName)+' WHERE repo_id = :repoId'), {'repoId': repoId})}
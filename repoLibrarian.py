@@ -6,7 +6,13 @@ For a demonstration of usage, refer to the RepoLibrarian notebook
 
 from git import Repo 
 import os
+import time
+import random
+import fcntl
 import shutil
+import sqlite3
+import subprocess
+from multiprocessing.pool import ThreadPool
 from git.db import GitDB
 from git.db import GitCmdObjectDB
 from git import GitCommandError
@@ -27,6 +33,19 @@ def setReposFolder(path):
 def getReposFolder():
     '''The current folder where repositories are saved, forms a current working set of repositories'''
     return reposFolder
+
+'''Url of the remote of a repository, formatted with user and project; can be changed with accessors, e.g. to `file:///some/folder/{user}/{project}.git` to test against local bare repositories'''
+remoteUrlTemplate = 'https://github.com/{user}/{project}.git'
+
+def setRemoteUrlTemplate(template):
+    '''Accessor to set the remote url template, see `remoteUrlTemplate`'''
+    global remoteUrlTemplate
+    remoteUrlTemplate = template
+    return remoteUrlTemplate
+
+def remoteUrl(user, project):
+    '''Url a repository is cloned from'''
+    return remoteUrlTemplate.format(user=user, project=project)
     
 def pathFor(user, project):
     '''Path where a repository would be saved if managed by this module'''
@@ -35,23 +54,25 @@ def pathFor(user, project):
     return reposFolder+user+'/'+project
 
 def knownRepos(path=''):
-    '''Deeply searches the current repos directory for repositories; Takes a path parameter for recursion or to descend into a subfolder'''
-    fullPath = reposFolder+path
-    for file in os.listdir(fullPath):
-        if file.endswith('.git'):
-            yield path+file
-        elif os.path.isdir(fullPath+file):
-            for element in knownRepos(path+file+'/'):
-                yield element
+    '''Deeply searches the current repos directory for repositories; Takes a path parameter for recursion or to descend into a subfolder. This walks the disk, use `managedRepos` for the indexed list'''
+    with os.scandir(reposFolder+path) as entries:
+        for entry in entries:
+            if entry.name.endswith('.git'):
+                yield path+entry.name
+            elif entry.is_dir():
+                for element in knownRepos(path+entry.name+'/'):
+                    yield element
+
+def splitPath(path):
+    '''Utility to extract user and project name from a path of `knownRepos`'''
+    split = path.split('/')
+    user = split[-2]
+    project = split[-1]
+    return (user, project)
 
 def managedRepos():
-    '''Wrapper for knownRepos that returns them in format (user,project) which is usefull to pass this tuples to other functions'''
-    def splitPath(path):
-        split = path.split('/')
-        user = split[-2]
-        project = split[-1]
-        return (user, project)
-    return list(map(splitPath, knownRepos()))
+    '''All repositories of the manifest in format (user,project) which is usefull to pass this tuples to other functions'''
+    return [(user, project+'.git') for (user, project) in queryManifest('SELECT user, project FROM repos ORDER BY user, project')]
 
 def splitUrl(url):
     '''Utility to extract user and project name from a github url'''
@@ -61,8 +82,21 @@ def splitUrl(url):
     return (user, project)
 
 def hasRepo(user, project):
-    '''Checks if a repository is managed by this module'''
-    return os.path.isdir(pathFor(user, project))
+    '''
+    Checks if a repository is managed by this module by a lookup in the manifest, which is confirmed by a look at the disk.
+    Repositories that are on disk but not in the manifest (e.g. cloned by other means) are listed in it without reading them (like in `recoverManifest`), entries of repositories that have been removed by other means are dropped.
+    Failures to update the manifest are printed, the answer of the disk is returned anyway
+    '''
+    onDisk = os.path.isdir(pathFor(user, project))
+    try:
+        managed = bool(queryManifest('SELECT 1 FROM repos WHERE user = ? AND project = ?', (user, projectName(project))))
+        if onDisk and not managed:
+            executeOnManifest('INSERT OR IGNORE INTO repos VALUES (?, ?, ?, ?, ?, ?, ?)', listingRow(user, project))
+        elif managed and not onDisk:
+            unregisterRepo(user, project)
+    except Exception as e:
+        print('Failed to update the manifest for "'+user+'/'+project+'": '+str(e))
+    return onDisk
 
 
 def deleteRepo(user, project):
@@ -70,7 +104,9 @@ def deleteRepo(user, project):
     if not hasRepo(user, project):
         print('Repo "'+user+'/'+project+'" does not exist locally')
     else:
-        shutil.rmtree(pathFor(user, project))
+        if os.path.isdir(pathFor(user, project)):
+            shutil.rmtree(pathFor(user, project))
+        unregisterRepo(user, project)
         print('Deleted repo "'+user+'/'+project+'"')
         
 
@@ -84,7 +120,8 @@ def downloadRepo(user, project, override=False):
         else:
             return
     try:
-        repo = Repo.clone_from(url=f'https://github.com/{user}/{project}.git', to_path=reposFolder+user+'/'+project+'.git', bare=True) 
+        repo = Repo.clone_from(url=remoteUrl(user, project), to_path=pathFor(user, project), bare=True)
+        registerRepo(user, project)
         print('Cloned repo "'+user+'/'+project+'"')
         return repo        
     except GitCommandError as err:
@@ -99,20 +136,257 @@ def getRepo(user, project):
     return Repo.init(pathFor(user, project), bare=True, odbt=GitCmdObjectDB)
 
 
+'''Refs that are updated by `fetchRepo`, the same ones a bare clone has'''
+fetchRefspecs = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+
+def cloneRepo(user, project, partial=None):
+    '''
+    Clones a repository into management without printing, raises GitCommandError on failure.
+    A partial clone filter (e.g. `blob:none` or `tree:0`) leaves out objects that are fetched from the remote only when they are read, note that this makes reading many old blobs slow
+    '''
+    options = {} if partial is None else {'filter': partial}
+    repo = Repo.clone_from(url=remoteUrl(user, project), to_path=pathFor(user, project), bare=True, **options)
+    registerRepo(user, project)
+    return repo
+
+def fetchRepo(user, project):
+    '''Updates branches and tags of a managed repository from its remote (pruning deleted ones), a partial clone keeps its filter'''
+    repo = Repo(pathFor(user, project))
+    repo.git.fetch('--prune', '--quiet', 'origin', *fetchRefspecs)
+    registerRepo(user, project)
+    return repo
+
+def acquireRepo(user, project, partial=None, fetch=True, retries=3, backoff=2):
+    '''
+    Clones a repository, or fetches it if it is already managed (only if `fetch`), retrying failed attempts after exponentially growing pauses.
+    Returns a status dict with `user`, `project`, `status` (cloned, fetched, exists, or failed), `attempts`, `error`, and `time`
+    '''
+    start = time.time()
+    status = {'user': user, 'project': project, 'status': None, 'attempts': 0, 'error': None, 'time': 0}
+    exists = hasRepo(user, project)
+    if exists and not fetch:
+        status['status'] = 'exists'
+        return status
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+        status['attempts'] = attempt + 1
+        try:
+            if exists:
+                fetchRepo(user, project)
+                status['status'] = 'fetched'
+            else:
+                cloneRepo(user, project, partial)
+                status['status'] = 'cloned'
+            status['error'] = None
+            break
+        except Exception as e:
+            status['status'] = 'failed'
+            status['error'] = str(e)
+            if not exists and os.path.exists(pathFor(user, project)):
+                shutil.rmtree(pathFor(user, project))
+    status['time'] = time.time() - start
+    return status
+
+def acquireRepos(repos, workers=8, partial=None, fetch=True, retries=3, backoff=2):
+    '''
+    Bulk version of `acquireRepo` for a list of `(user, project)` tuples, which clones or fetches up to `workers` repositories at a time (the work is network bound, so threads are used).
+    Returns the list of status dicts in the order of the given repos, e.g. to be inspected as dataframe
+    '''
+    def acquire(repoTuple):
+        (user, project) = repoTuple[:2]
+        return acquireRepo(user, project, partial, fetch, retries, backoff)
+    with ThreadPool(max(1, workers)) as pool:
+        return pool.map(acquire, repos, chunksize=1)
+
+
+'''
+The manifest indexes the repositories of a repos folder in an SQLite file inside of it, so that listing and lookups do not walk the disk.
+It records path, size, HEAD sha, and commit count of each repository and caches the `isJavaRepo` result for its HEAD.
+Downloading and deleting keep it up to date; if repositories were changed by other means, `rebuildManifest` restores it from disk.
+A missing manifest is recreated on first use from the directory listing alone (by one process, the others wait for it), size, HEAD, and commit count are then filled in by `manifestEntries` when they are asked for
+'''
+manifestName = '.manifest.sqlite'
+
+def manifestPath():
+    '''Path of the manifest of the current repos folder'''
+    return reposFolder+manifestName
+
+def projectName(project):
+    '''Project name as stored in the manifest, without `.git`'''
+    return project[:-len('.git')] if project.endswith('.git') else project
+
+def queryManifest(query, parameters=()):
+    '''Runs a statement on the manifest of the current repos folder and returns all rows; indexes the repos folder if there is no manifest yet, see `recoverManifest`'''
+    if not os.path.exists(manifestPath()):
+        recoverManifest()
+    return executeOnManifest(query, parameters)
+
+def recoverManifest():
+    '''
+    Creates a missing manifest from the directory listing only, without reading the repositories, which would take long for large repos folders.
+    Holds a lock file meanwhile and checks again after getting it, so that concurrent workers do not all index the folder
+    '''
+    os.makedirs(reposFolder, exist_ok=True)
+    with open(manifestPath()+'.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(manifestPath()):
+                rebuildManifest(describe=False)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def executeOnManifest(query, parameters=(), many=False, path=None):
+    '''Runs a statement on the manifest (or another manifest file) without checking for its existence; every call has its own connection, so it can be used from threads and processes'''
+    db = sqlite3.connect(path or manifestPath(), timeout=60)
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS repos (user TEXT, project TEXT, path TEXT, size INTEGER, head TEXT, commits INTEGER, java INTEGER, PRIMARY KEY (user, project))')
+        rows = (db.executemany if many else db.execute)(query, parameters).fetchall()
+        db.commit()
+        return rows
+    finally:
+        db.close()
+
+def diskSize(path):
+    '''Size of a directory in bytes'''
+    size = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                size += diskSize(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+def listingRow(user, project, path=None):
+    '''Manifest row of a repository that is only known from the directory listing, size, head, commits, and java are left unknown (None)'''
+    return (user, projectName(project), path or pathFor(user, project), None, None, None, None)
+
+def describeRepo(user, project, path=None):
+    '''Manifest row of a repository on disk: (user, project, path, size, head, commits, java); head is None for empty repositories and java is not known yet'''
+    path = path or pathFor(user, project)
+    git = Repo(path).git
+    try:
+        head = git.rev_parse('--verify', '--quiet', 'HEAD')
+        commits = int(git.rev_list('--all', '--count'))
+    except GitCommandError:
+        head, commits = None, 0
+    return (user, projectName(project), path, diskSize(path), head, commits, None)
+
+def registerRepo(user, project):
+    '''Adds (or updates) a repository in the manifest, the cached classification is kept if HEAD did not change'''
+    row = describeRepo(user, project)
+    known = executeOnManifest('SELECT head, java FROM repos WHERE user = ? AND project = ?', row[:2])
+    if known and known[0][0] == row[4]:
+        row = row[:-1] + (known[0][1],)
+    executeOnManifest('INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+
+def unregisterRepo(user, project):
+    '''Removes a repository from the manifest'''
+    executeOnManifest('DELETE FROM repos WHERE user = ? AND project = ?', (user, projectName(project)))
+
+def rebuildManifest(workers=8, describe=True):
+    '''
+    Recreates the manifest of the current repos folder from disk (`knownRepos`), classifications of repositories whose HEAD did not change are kept.
+    Without `describe`, only the repositories found are listed and size, HEAD, commit count, and classification are left unknown (None), see `recoverManifest`.
+    The new manifest is written to a temporary file that replaces the old one at once, so other processes never see a partial manifest
+    '''
+    known = {}
+    if os.path.exists(manifestPath()):
+        known = {(user, project): (head, java) for (user, project, head, java) in executeOnManifest('SELECT user, project, head, java FROM repos')}
+    def describeAt(path):
+        try:
+            row = describeRepo(*splitPath(path), reposFolder+path)
+        except Exception as e:
+            print('Failed to index '+path+': '+str(e))
+            return None
+        (head, java) = known.get(row[:2], (None, None))
+        return row[:-1] + (java if head == row[4] else None,)
+    if describe:
+        with ThreadPool(max(1, workers)) as pool:
+            rows = [row for row in pool.map(describeAt, list(knownRepos())) if row is not None]
+    else:
+        rows = [listingRow(*splitPath(path), reposFolder+path) for path in knownRepos()]
+    temporaryPath = manifestPath()+'.'+str(os.getpid())
+    if os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
+    executeOnManifest('INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?, ?, ?, ?)', rows, many=True, path=temporaryPath)
+    os.replace(temporaryPath, manifestPath())
+    return len(rows)
+
+def manifestEntries():
+    '''All manifest rows as dicts, e.g. to be inspected as dataframe; rows that are only known from the directory listing are described (and updated) here, see `recoverManifest`'''
+    columns = ['user', 'project', 'path', 'size', 'head', 'commits', 'java']
+    rows = queryManifest('SELECT * FROM repos ORDER BY user, project')
+    for index, row in enumerate(rows):
+        if row[3] is None and os.path.isdir(row[2]):
+            try:
+                rows[index] = describeRepo(row[0], row[1], row[2])[:-1] + (row[6],)
+            except Exception as e:
+                print('Failed to describe '+row[2]+': '+str(e))
+                continue
+            executeOnManifest('UPDATE repos SET size = ?, head = ?, commits = ? WHERE user = ? AND project = ? AND size IS NULL', rows[index][3:6] + row[:2])
+    return [dict(zip(columns, row)) for row in rows]
+
+
+class CatFile:
+    '''
+    Long-lived `git cat-file --batch` process for one repository, used to read many blobs by sha without tree walks or one round trip per object.
+    Requests are written in chunks and answered in bulk; a chunk stays below the pipe buffer size, so git never blocks on its output while requests are still being written.
+    Use as context manager, so the process is ended when a repository is done
+    '''
+    chunkSize = 256
+
+    def __init__(self, repo):
+        self.process = subprocess.Popen(['git', '--git-dir', repo.git_dir, 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, shas):
+        '''Returns the contents of the given objects as dict from sha to bytes, missing objects are left out'''
+        contents = {}
+        shas = list(shas)
+        for start in range(0, len(shas), self.chunkSize):
+            chunk = shas[start:start+self.chunkSize]
+            self.process.stdin.write(('\n'.join(chunk)+'\n').encode())
+            self.process.stdin.flush()
+            for sha in chunk:
+                header = self.process.stdout.readline().split()
+                if len(header) < 3 or header[1] == b'missing':
+                    continue
+                contents[sha] = self.process.stdout.read(int(header[2]))
+                self.process.stdout.read(1)# Trailing newline after each object
+        return contents
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        
+
 def isJavaFile(gitObject):
     '''Checks if gitpython gitobject is a java source code file'''
     return gitObject.type == 'blob' and gitObject.name.endswith('.java')
 
 def isJavaRepo(user, project, *args):
-    '''Checks if a repository is a java repository, downloads repository if necessary and returns false if errors occur'''
+    '''Checks if a repository is a java repository, downloads repository if necessary and returns false if errors occur. The result is cached in the manifest until HEAD changes'''
     try:
         repo = getRepo(user, project)
     except Exception as e:
         print('Failed to download '+str((user, project))+': '+str(e))
         return False
     
+    cached = queryManifest('SELECT java FROM repos WHERE user = ? AND project = ?', (user, projectName(project)))
+    if cached and cached[0][0] is not None:
+        return bool(cached[0][0])
     try:
-        return next(filter(lambda x: x.endswith('.java'), repo.git.ls_tree('--full-tree', '--name-only', '-r', 'HEAD').split('\n')), None) != None
+        java = next(filter(lambda x: x.endswith('.java'), repo.git.ls_tree('--full-tree', '--name-only', '-r', 'HEAD').split('\n')), None) != None
     except Exception as e:
         print('Failed to check '+str((user, project))+': '+str(e))
-        return False
\ No newline at end of file
+        return False
+    executeOnManifest('UPDATE repos SET java = ? WHERE user = ? AND project = ?', (int(java), user, projectName(project)))
+    return java
\ No newline at end of file
@@ -0,0 +1,173 @@
+'''
+This module moves writing of analysis results out of the analysis workers.
+Workers push batches of result rows to a queue and a single writer process writes them to a target, so workers never wait for each other or for the database.
+Targets are pluggable:
+- `PostgresTarget` streams batches into postgres with `COPY FROM STDIN` over one pooled connection (used for the real runs)
+- `SqlTarget` writes with `DataFrame.to_sql` to any SQLAlchemy database, e.g. a local SQLite file for testing without a server
+- `CsvTarget` appends batches to one csv file per table
+Batches can carry a checkpoint callback (see the checkpoints module), which the writer calls after the batch has been written
+'''
+
+import os
+import io
+import csv
+import multiprocessing
+
+import numpy
+import sqlalchemy
+from sqlalchemy import MetaData, Table
+
+import dbUtils
+import telemetry
+import queryCache
+import connections
+
+# ===== Targets =====
+class SqlTarget(connections.SqlDatabase):
+    '''Writes result batches to a table of any SQLAlchemy database. The engine is created lazily, so every process that writes has its own connections'''
+
+    def createTable(self, tableName, columns):
+        meta = MetaData(schema=self.schema)
+        Table(tableName, meta, *columns)
+        meta.create_all(self.engine)
+        queryCache.invalidateTables([tableName])
+
+    def write(self, tableName, data):
+        data.to_sql(tableName, schema=self.schema, con=self.engine, if_exists='append', index=False)
+
+    def close(self):
+        if self._engine is not None:
+            self._engine.dispose()
+            self._engine = None
+
+
+class PostgresTarget(SqlTarget):
+    '''
+    Streams result batches into postgres with `COPY FROM STDIN`, which is much faster than the row by row inserts of `to_sql`.
+    Defaults to the database and schema of the dbUtils module. The writer keeps its connection open for the whole run
+    '''
+
+    def __init__(self, url=None, schema=dbUtils.defaultSchema):
+        super().__init__(url or dbUtils.engine.url, schema)
+        self.connection = None
+        self.integerColumns = {}
+
+    def __getstate__(self):
+        return dict(super().__getstate__(), connection=None, integerColumns={})
+
+    def integerColumnsOf(self, tableName):
+        '''Integer columns of a table; float values (e.g. total_indent) are rounded for them like postgres does on insert, as COPY does not cast'''
+        if tableName not in self.integerColumns:
+            columns = sqlalchemy.inspect(self.engine).get_columns(tableName, schema=self.schema)
+            self.integerColumns[tableName] = {column['name'] for column in columns if isinstance(column['type'], sqlalchemy.Integer)}
+        return self.integerColumns[tableName]
+
+    def write(self, tableName, data):
+        if self.connection is None:
+            self.connection = self.engine.raw_connection()
+        data = data.copy()
+        for column in self.integerColumnsOf(tableName) & set(data.columns):
+            if data[column].dtype.kind == 'f':
+                data[column] = (numpy.sign(data[column]) * numpy.floor(numpy.abs(data[column]) + 0.5)).astype('Int64')
+        buffer = io.StringIO()
+        data.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        quoted = lambda name: '"'+name+'"'
+        table = '.'.join(map(quoted, [self.schema, tableName] if self.schema else [tableName]))
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.copy_expert('COPY '+table+' ('+', '.join(map(quoted, data.columns))+') FROM STDIN WITH (FORMAT csv)', buffer)
+            self.connection.commit()
+        except Exception:
+            # A failed COPY aborts the transaction, which has to be ended before the connection can be used for the next batch
+            self.connection.rollback()
+            raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        super().close()
+
+
+class CsvTarget:
+    '''Appends result batches to `<folder>/<tableName>.csv`, the header is written when the table is created. Existing files are kept, so that resumed runs append to them'''
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def pathFor(self, tableName):
+        return os.path.join(self.folder, tableName+'.csv')
+
+    def createTable(self, tableName, columns):
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.pathFor(tableName)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            return
+        with open(path, 'w', newline='') as file:
+            csv.writer(file).writerow([column.name for column in columns])
+
+    def write(self, tableName, data):
+        data.to_csv(self.pathFor(tableName), mode='a', index=False, header=False)
+
+    def close(self):
+        pass
+
+
+# ===== Writer process =====
+'''The queue of the current process (set in pool workers by `attach`), None if results are written directly'''
+resultQueue = None
+
+def attach(queue):
+    '''Pool initializer that makes `push` send results to the writer process behind the given queue'''
+    global resultQueue
+    resultQueue = queue
+
+def push(data, tableName, checkpoint=None):
+    '''
+    Passes a batch of results on to the writer process; falls back to writing directly to the dbUtils database if no writer is attached.
+    An optional checkpoint callback is called as `checkpoint(data, written)` once the batch has (or has not) been written; data None only sends the callback, e.g. to mark the end of a task
+    '''
+    if resultQueue is None:
+        if data is not None:
+            dbUtils.writeDataToDb(data, tableName)
+        if checkpoint is not None:
+            checkpoint(data, True)
+    else:
+        resultQueue.put((tableName, data, checkpoint))
+
+def writerLoop(queue, target, logfile='log.txt'):
+    '''Main function of the writer process, writes batches (and calls their checkpoint callbacks) until it receives None. Records its write times as telemetry, if enabled'''
+    with telemetry.recorded('writer', type(target).__name__):
+        try:
+            for tableName, data, checkpoint in telemetry.timedIterator('queueWait', iter(queue.get, None)):
+                written = True
+                if data is not None:
+                    try:
+                        with telemetry.stage('dbWrite'):
+                            target.write(tableName, data)
+                        telemetry.count('rows', len(data))
+                        queryCache.invalidateTables([tableName])
+                    except Exception as e:
+                        written = False
+                        dbUtils.log('Failed to write '+str(len(data))+' rows to '+tableName+': '+str(e), logfile)
+                if checkpoint is not None:
+                    try:
+                        with telemetry.stage('checkpoint'):
+                            checkpoint(data, written)
+                    except Exception as e:
+                        dbUtils.log('Failed to record checkpoint for '+tableName+': '+str(e), logfile)
+        finally:
+            target.close()
+
+def startWriter(target, logfile='log.txt', maxBatches=64):
+    '''Starts a writer process for the given target and returns its queue; the queue is bounded, so workers wait if the writer falls behind instead of filling memory'''
+    queue = multiprocessing.Queue(maxBatches)
+    process = multiprocessing.Process(target=writerLoop, args=(queue, target, logfile), daemon=True)
+    process.start()
+    return queue, process
+
+def stopWriter(queue, process):
+    '''Lets the writer process write all remaining batches and waits for it to end'''
+    queue.put(None)
+    process.join()
@@ -0,0 +1,175 @@
+'''
+This module records where the time of an analysis run goes, so it can be told whether a slow run is bound by git, by the database, or by the regexes.
+The analysis code marks its stages (git log read, blob fetch, decode, header and comment stripping, each metric, DataFrame build, and writing) and counts commits, blobs, and bytes.
+While telemetry is disabled (the default), stages and counters cost next to nothing.
+When enabled, one JSON line is appended per analyzed repository (and one for the writer process), and `runFullAnalysis` adds an aggregate line per run.
+Chosen repositories can additionally be profiled with cProfile, one `.prof` file per repository
+'''
+
+import os
+import json
+import time
+import cProfile
+import contextlib
+import multiprocessing
+from collections import defaultdict
+
+'''Path of the JSON lines file, None disables telemetry. Can be changed with `configure`'''
+telemetryPath = None
+'''Repositories as (user, project) that are profiled, and the folder the profiles are saved to'''
+profileRepos = set()
+profileFolder = None
+'''Identifies the records of one run in the telemetry file'''
+runId = None
+
+stageTimes = defaultdict(float)
+stageCalls = defaultdict(int)
+counters = defaultdict(int)
+
+telemetrySemaphore = multiprocessing.Semaphore()
+noStage = contextlib.nullcontext()
+
+def configure(path=None, profile=(), folder=None):
+    '''Enables telemetry to the given file (or disables it with None), optionally profiling the given (user, project) repositories into a folder (by default the one of the file)'''
+    global telemetryPath, profileRepos, profileFolder, runId
+    telemetryPath = path
+    profileRepos = {tuple(repo[:2]) for repo in profile}
+    profileFolder = folder
+    if profileFolder is None and path is not None:
+        profileFolder = os.path.dirname(os.path.abspath(path))
+    runId = time.strftime('%Y-%m-%dT%H:%M:%S')+'-'+str(os.getpid())
+    reset()
+    return telemetryPath
+
+def isEnabled():
+    '''Whether telemetry is recorded'''
+    return telemetryPath is not None
+
+class Stage:
+    '''Context manager that adds its run time to a stage'''
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        stageTimes[self.name] += time.perf_counter() - self.start
+        stageCalls[self.name] += 1
+
+def stage(name):
+    '''Times a block as stage `name`: `with telemetry.stage('blobFetch'): ...`'''
+    return Stage(name) if telemetryPath is not None else noStage
+
+def count(name, amount=1):
+    '''Adds to a counter, e.g. of processed blobs'''
+    if telemetryPath is not None:
+        counters[name] += amount
+
+def timedIterator(name, iterable):
+    '''Passes on the items of an iterable and times how long producing them takes as stage `name`, e.g. for lazily read git output'''
+    if telemetryPath is None:
+        return iterable
+    def timed():
+        iterator = iter(iterable)
+        while True:
+            with Stage(name):
+                item = next(iterator, noStage)
+            if item is noStage:
+                return
+            yield item
+    return timed()
+
+def reset():
+    '''Clears all stages and counters of the current process'''
+    stageTimes.clear()
+    stageCalls.clear()
+    counters.clear()
+
+def snapshot():
+    '''Stages and counters of the current process as dict'''
+    return {
+        'stages': {name: {'seconds': stageTimes[name], 'calls': stageCalls[name]} for name in sorted(stageTimes)},
+        'counters': dict(sorted(counters.items()))
+    }
+
+def writeRecord(record):
+    '''Appends a record as JSON line to the telemetry file'''
+    if telemetryPath is None:
+        return
+    record = dict(record, run=runId, pid=os.getpid())
+    with telemetrySemaphore:
+        with open(telemetryPath, 'a') as file:
+            file.write(json.dumps(record)+'\n')
+
+@contextlib.contextmanager
+def recorded(kind, name, **fields):
+    '''
+    Records stages and counters of a block (e.g. the analysis of one repository) as one JSON line with its total time.
+    Profiles the block if `name` is a (user, project, ...) tuple of a repository to be profiled
+    '''
+    if telemetryPath is None:
+        yield
+        return
+    reset()
+    profiler = None
+    if isinstance(name, tuple) and tuple(name[:2]) in profileRepos and profileFolder is not None:
+        profiler = cProfile.Profile()
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            suffix = '_'.join(str(value) for value in fields.values() if value is not None)
+            profiler.dump_stats(os.path.join(profileFolder, '_'.join(map(str, name[:2])) + ('_'+suffix if suffix else '') + '.prof'))
+        record = {'type': kind, 'name': list(name) if isinstance(name, tuple) else name, 'seconds': time.perf_counter() - start}
+        record.update(fields)
+        record.update(snapshot())
+        writeRecord(record)
+        reset()
+
+def readRecords(path=None, run=None):
+    '''Records of a telemetry file, optionally only those of one run'''
+    with open(path or telemetryPath) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    return [record for record in records if run is None or record.get('run') == run]
+
+def aggregate(records):
+    '''Sums stages and counters over records; shares of stages are relative to the summed record times (which exceed wall time when processes run in parallel)'''
+    seconds = sum(record['seconds'] for record in records)
+    stages = defaultdict(lambda: {'seconds': 0, 'calls': 0})
+    totals = defaultdict(int)
+    for record in records:
+        for name, values in record['stages'].items():
+            stages[name]['seconds'] += values['seconds']
+            stages[name]['calls'] += values['calls']
+        for name, value in record['counters'].items():
+            totals[name] += value
+    for values in stages.values():
+        values['share'] = values['seconds'] / seconds if seconds else 0
+    return {'records': len(records), 'seconds': seconds, 'stages': dict(sorted(stages.items(), key=lambda item: -item[1]['seconds'])), 'counters': dict(sorted(totals.items()))}
+
+def recordRun(wallTime, **fields):
+    '''Aggregates the repository records and the writer records of the current run separately, appends the aggregate as JSON line, and returns it'''
+    if telemetryPath is None or not os.path.exists(telemetryPath):
+        return None
+    records = readRecords(telemetryPath, runId)
+    record = dict({'type': 'run', 'name': runId, 'wallTime': wallTime}, **fields)
+    for kind in ['repo', 'writer']:
+        record[kind] = aggregate([entry for entry in records if entry['type'] == kind])
+    writeRecord(record)
+    return record
+
+def formatSummary(summary):
+    '''Human readable table of an aggregate, e.g. for the log file'''
+    lines = [str(summary['records'])+' records, '+('%.2f' % summary['seconds'])+' s']
+    for name, values in summary['stages'].items():
+        lines.append('  '+name.ljust(28)+('%.3f s' % values['seconds']).rjust(14)+('%d calls' % values['calls']).rjust(14)+('%.1f %%' % (100 * values['share'])).rjust(10))
+    for name, value in summary['counters'].items():
+        lines.append('  '+name.ljust(28)+str(value).rjust(14))
+    return '\n'.join(lines)
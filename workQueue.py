@@ -0,0 +1,177 @@
+'''
+This module distributes analysis runs over several machines.
+A coordinator puts the tasks of a run (repositories or commit ranges of them, see `repoAnalysis.planTasks`) as work items into a queue table of a shared database, and every analysis machine runs workers against it:
+- workers claim the largest unclaimed item with `SELECT ... FOR UPDATE SKIP LOCKED`, so claims never wait for each other and no item is handed out twice
+- a claim is a lease that the machine extends by heartbeats while the item is analyzed and its results are written
+- items whose lease runs out (e.g. because the machine crashed) are claimed again by other workers, failed items are requeued until they run out of attempts
+Items are completed by the writer process of the resultSink module after their results have been written, like checkpoints.
+Postgres is used for real runs; SQLite works as local stand-in (claims are atomic there, as SQLite runs one write statement at a time), e.g. for several local worker processes on one machine.
+Lease times are taken from the clock of the database, so clocks of the machines do not have to agree
+'''
+
+import os
+import json
+import uuid
+import socket
+import threading
+
+import sqlalchemy
+from sqlalchemy import MetaData, Table, Column, Index, Integer, String, Float, Text
+
+import connections
+
+'''Default lease time in seconds; workers extend leases every third of it, so an item is claimed again at most this long after its machine stopped'''
+defaultLeaseSeconds = 300
+'''Default number of attempts per item, items that fail as often are given up'''
+defaultMaxAttempts = 3
+
+# ===== Queue tables =====
+class WorkQueue(connections.SqlDatabase):
+    '''Queue tables `work_runs` and `work_items` in a SQLAlchemy database, every process that uses the queue has its own engine'''
+
+    def isPostgres(self):
+        return self.engine.dialect.name == 'postgresql'
+
+    def now(self):
+        '''SQL expression for the current time of the database in seconds since epoch'''
+        return 'EXTRACT(EPOCH FROM clock_timestamp())' if self.isPostgres() else "((julianday('now') - 2440587.5) * 86400.0)"
+
+    def execute(self, query, **params):
+        '''Runs a statement in its own transaction, returns the fetched rows (if any) and the number of changed rows'''
+        with self.engine.begin() as connection:
+            result = connection.execute(sqlalchemy.text(query), params)
+            rows = [tuple(row) for row in result] if result.returns_rows else []
+            return rows, result.rowcount
+
+    def createTables(self):
+        meta = MetaData(schema=self.schema)
+        Table('work_runs', meta,
+            Column('run_id', String, primary_key=True), Column('table_name', String), Column('suite', String),
+            Column('lease_seconds', Float), Column('max_attempts', Integer), Column('created', Float))
+        Table('work_items', meta,
+            Column('item_id', Integer, primary_key=True, autoincrement=True), Column('run_id', String), Column('task', Text), Column('priority', Integer),
+            Column('status', String), Column('owner', String), Column('token', String, index=True), Column('lease_expires', Float), Column('attempts', Integer),
+            Column('write_failed', Integer), Column('rows', Integer), Column('error', Text),
+            Index('work_items_order', 'run_id', 'priority'))
+        meta.create_all(self.engine)
+
+    # ===== Coordinator =====
+    def enqueue(self, runId, tableName, suite, tasks, leaseSeconds=defaultLeaseSeconds, maxAttempts=defaultMaxAttempts):
+        '''Creates a run and puts its tasks `(repoTuple, commitRange, estimate)` into the queue, tasks are claimed in the given order (`planTasks` sorts them largest-first)'''
+        self.createTables()
+        with self.engine.begin() as connection:
+            connection.execute(sqlalchemy.text('INSERT INTO '+self.qualified('work_runs')+' VALUES (:run, :tableName, :suite, :lease, :attempts, '+self.now()+')'),
+                {'run': runId, 'tableName': tableName, 'suite': suite, 'lease': leaseSeconds, 'attempts': maxAttempts})
+            items = [{'run': runId, 'task': json.dumps([list(repo), commitRange, estimate]), 'priority': priority} for priority, (repo, commitRange, estimate) in enumerate(tasks)]
+            if items:
+                connection.execute(sqlalchemy.text('INSERT INTO '+self.qualified('work_items')+" (run_id, task, priority, status, attempts, write_failed) VALUES (:run, :task, :priority, 'queued', 0, 0)"), items)
+        return len(tasks)
+
+    def run(self, runId):
+        '''Settings of a run as dict, None if there is no such run'''
+        rows, _ = self.execute('SELECT table_name, suite, lease_seconds, max_attempts FROM '+self.qualified('work_runs')+' WHERE run_id = :run', run=runId)
+        return dict(zip(['tableName', 'suite', 'leaseSeconds', 'maxAttempts'], rows[0])) if rows else None
+
+    def summary(self, runId):
+        '''Number of items of a run per status and their result rows (of the last attempt); claimed items with run out leases count as `expired`, expired items without attempts left as `failed`'''
+        rows, _ = self.execute('SELECT i.status, i.lease_expires < '+self.now()+', i.attempts >= r.max_attempts, COUNT(*), SUM(COALESCE(i.rows, 0)) FROM '+self.qualified('work_items')+' i JOIN '
+            + self.qualified('work_runs')+' r ON i.run_id = r.run_id WHERE i.run_id = :run GROUP BY 1, 2, 3', run=runId)
+        summary = {'queued': 0, 'claimed': 0, 'expired': 0, 'done': 0, 'failed': 0, 'rows': 0}
+        for status, expired, exhausted, items, rows in rows:
+            if status == 'claimed' and expired:
+                status = 'failed' if exhausted else 'expired'
+            summary[status] += items
+            summary['rows'] += rows
+        return summary
+
+    # ===== Workers =====
+    def claim(self, runId, owner, leaseSeconds, maxAttempts):
+        '''
+        Claims the first item of a run that is queued or whose lease has run out, returns `(itemId, token, attempt, task)` or None if there is none.
+        On postgres, `SKIP LOCKED` makes concurrent claims pass over the item another transaction is claiming instead of waiting for it
+        '''
+        token = uuid.uuid4().hex
+        items = self.qualified('work_items')
+        lock = ' FOR UPDATE SKIP LOCKED' if self.isPostgres() else ''
+        # One transaction, so that a claim is never made without being returned
+        with self.engine.begin() as connection:
+            connection.execute(sqlalchemy.text('UPDATE '+items+" SET status = 'claimed', owner = :owner, token = :token, attempts = attempts + 1, write_failed = 0, lease_expires = "+self.now()+' + :lease'
+                + ' WHERE item_id = (SELECT item_id FROM '+items+" WHERE run_id = :run AND attempts < :attempts AND (status = 'queued' OR (status = 'claimed' AND lease_expires < "+self.now()+'))'
+                + ' ORDER BY priority LIMIT 1'+lock+')'), {'owner': owner, 'token': token, 'lease': leaseSeconds, 'run': runId, 'attempts': maxAttempts})
+            rows = connection.execute(sqlalchemy.text('SELECT item_id, attempts, task FROM '+items+' WHERE token = :token'), {'token': token}).fetchall()
+        if not rows:
+            return None
+        (itemId, attempt, task) = rows[0]
+        (repo, commitRange, estimate) = json.loads(task)
+        return itemId, token, attempt, (repo, tuple(commitRange) if commitRange is not None else None, estimate)
+
+    def isRunning(self, runId, maxAttempts):
+        '''Whether a run has items that are claimed by a live worker or can still be claimed'''
+        rows, _ = self.execute('SELECT COUNT(*) FROM '+self.qualified('work_items')+" WHERE run_id = :run AND (status = 'queued' OR status = 'claimed') AND (attempts < :attempts OR lease_expires >= "+self.now()+')',
+            run=runId, attempts=maxAttempts)
+        return rows[0][0] > 0
+
+    def heartbeat(self, runId, owner, leaseSeconds):
+        '''Extends the leases of all items of a run the owner holds, returns their number'''
+        _, extended = self.execute('UPDATE '+self.qualified('work_items')+' SET lease_expires = '+self.now()+" + :lease WHERE run_id = :run AND owner = :owner AND status = 'claimed'",
+            lease=leaseSeconds, run=runId, owner=owner)
+        return extended
+
+    def markWriteFailed(self, itemId, token):
+        '''Records that a batch of results of a claimed item could not be written, so that `finish` requeues it'''
+        self.execute('UPDATE '+self.qualified('work_items')+' SET write_failed = 1 WHERE item_id = :item AND token = :token', item=itemId, token=token)
+
+    def finish(self, itemId, token, rows, error=None):
+        '''
+        Completes a claimed item with its number of result rows, or puts it back into the queue if it failed (rows None, or a batch could not be written); it is given up after its last attempt.
+        Returns the new status, None if the claim has been lost to another worker in the meantime
+        '''
+        items = self.qualified('work_items')
+        _, changed = self.execute('UPDATE '+items+" SET status = CASE WHEN :failed = 0 AND write_failed = 0 THEN 'done' WHEN attempts < (SELECT max_attempts FROM "+self.qualified('work_runs')
+            + " r WHERE r.run_id = "+items+".run_id) THEN 'queued' ELSE 'failed' END, rows = :rows, error = CASE WHEN write_failed = 1 THEN 'results could not be written' ELSE :error END,"
+            + " owner = NULL, token = NULL WHERE item_id = :item AND token = :token AND status = 'claimed'",
+            failed=int(rows is None), rows=rows, error=error, item=itemId, token=token)
+        if not changed:
+            return None
+        return self.execute('SELECT status FROM '+items+' WHERE item_id = :item', item=itemId)[0][0][0]
+
+def ownerId():
+    '''Identifies the workers of one machine in the queue, the heartbeats of a machine extend the leases of all of its workers'''
+    return socket.gethostname()+':'+str(os.getpid())+':'+uuid.uuid4().hex[:8]
+
+def markItemWritten(queue, itemId, token, data, written):
+    '''Writer callback for a batch of results of an item: marks the item as failed if the batch could not be written. Does nothing for the end marker (data None), see `markItemDone`'''
+    if data is not None and not written:
+        queue.markWriteFailed(itemId, token)
+
+def markItemDone(queue, itemId, token, rows, data, written):
+    '''Writer callback after the last batch of an item, completes (or requeues) it once all of its results have been written'''
+    status = queue.finish(itemId, token, rows, None if rows is not None else 'analysis failed')
+    if status is None:
+        print('Lost the lease of work item '+str(itemId)+' before its results were written')
+
+class Heartbeat:
+    '''Context manager that extends the leases of an owner from a background thread every third of the lease time'''
+
+    def __init__(self, queue, runId, owner, leaseSeconds):
+        self.queue = queue
+        self.runId = runId
+        self.owner = owner
+        self.leaseSeconds = leaseSeconds
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    def beat(self):
+        while not self.stopped.wait(self.leaseSeconds / 3):
+            try:
+                self.queue.heartbeat(self.runId, self.owner, self.leaseSeconds)
+            except Exception as e:
+                print('Failed to send heartbeat: '+str(e))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()